@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Compare per-row and batched CSV encoding of a synthetic result
+
+Usage: python benchmarks/bench_encoding.py [--rows 10000000]
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import argparse
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from src import sql2csv  # noqa: E402
+
+
+class FakeCursor:
+    """ Minimal cursor exposing a PostgreSQL-like description """
+
+    description = [
+        ('id', 23, None, None, None, None, None),  # int4
+        ('name', 25, None, None, None, None, None),  # text
+        ('amount', 1700, None, None, None, None, None),  # numeric
+        ('created_at', 1114, None, None, None, None, None),  # timestamp
+        ('payload', 3802, None, None, None, None, None),  # jsonb
+    ]
+
+
+def get_batch(size):
+    """ Return a batch of synthetic rows """
+
+    return [
+        (i, 'name %d' % i, Decimal('%d.25' % i),
+         datetime(2018, 12, 1, 12, 23, 12), {'key': i})
+        for i in range(size)
+    ]
+
+
+def stringify_items(row):
+    """ Previous per-row implementation, kept as a baseline """
+
+    row = list(row)
+    for k, item in enumerate(row):
+        if (isinstance(item, dict)):
+            row[k] = json.dumps(item)
+
+    return tuple(row)
+
+
+def per_row(file_, batch, batches):
+    """ Baseline: `stringify_items()` and `writerow()` for every row """
+
+    writer = sql2csv.get_writer(file_)
+    for _ in range(batches):
+        for row in batch:
+            writer.writerow(stringify_items(row))
+
+
+def batched(file_, batch, batches):
+    """ Converter plan built once, rows written with `writerows()` """
+
+    writer = sql2csv.get_writer(file_)
+    converters = sql2csv.get_converters(FakeCursor, engine='postgresql')
+    for _ in range(batches):
+        writer.writerows(sql2csv.convert_rows(batch, converters))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000000,
+                        help="Number of rows to encode")
+    args = parser.parse_args()
+
+    batch = get_batch(sql2csv.FETCH_SIZE)
+    batches = max(1, args.rows // len(batch))
+    rows = batches * len(batch)
+
+    for name, function in (('per-row', per_row), ('batched', batched)):
+        with open(os.devnull, 'w', newline='') as file_:
+            start = time.perf_counter()
+            function(file_, batch, batches)
+            elapsed = time.perf_counter() - start
+
+        print('%-8s %s rows in %.2fs: %s rows/sec' % (
+            name, "{:,}".format(rows), elapsed,
+            "{:,.0f}".format(rows / elapsed)))
+
+
+if __name__ == '__main__':
+    main()
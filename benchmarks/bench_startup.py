@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Measure the cold start of sql2csv with `python -X importtime`
+
+Each run is a fresh interpreter converting a small dump piped to stdin, the
+way short cron jobs use sql2csv. The import time of the module and the wall
+time of the run are reported, and the run fails if the median import time is
+above --target-ms or if a database driver is imported in stdin mode.
+
+Usage: python benchmarks/bench_startup.py [--runs 20] [--target-ms 50]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Modules only needed once a query runs, never in stdin mode
+DEFERRED_MODULES = ['pymysql', 'psycopg2', 'sqlite3', 'yaml', 'pyarrow',
+                    'concurrent.futures', 'tempfile']
+
+SCRIPT = 'import sys; sys.path.insert(0, %r); from src import sql2csv; sql2csv.main()' % (ROOT)
+
+DUMP = b'id\tname\n1\thello world\n2\thello\n'
+
+
+def parse_importtime(stderr):
+    """ Return {module: cumulative microseconds} from `-X importtime` output """
+
+    modules = {}
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+
+    return modules
+
+
+def run_once():
+    """ Run the stdin conversion in a fresh interpreter """
+    """ Return (import time in ms, wall time in ms, imported modules) """
+
+    # Bytecode is written on the warm-up run, as for an installed package
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT],
+                             input=DUMP, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, env=env, check=True)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    modules = parse_importtime(process.stderr)
+
+    return modules.get('src.sql2csv', 0) / 1000, elapsed, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20,
+                        help="Number of interpreter starts measured")
+    parser.add_argument("--target-ms", type=float, default=50,
+                        help="Maximum median import time of sql2csv")
+    args = parser.parse_args()
+
+    run_once()  # Warm-up
+
+    import_times, wall_times = [], []
+    for _ in range(args.runs):
+        import_time, wall_time, modules = run_once()
+        import_times.append(import_time)
+        wall_times.append(wall_time)
+
+    import_time = statistics.median(import_times)
+    print('import sql2csv   median %6.1f ms  (min %.1f, max %.1f)' % (
+        import_time, min(import_times), max(import_times)))
+    print('stdin run        median %6.1f ms  (min %.1f, max %.1f)' % (
+        statistics.median(wall_times), min(wall_times), max(wall_times)))
+
+    # Slowest direct imports of the last run
+    print('\nslowest imports (cumulative ms):')
+    top = sorted(((time_, name) for name, time_ in modules.items()
+                  if name != 'src.sql2csv' and '.' not in name), reverse=True)
+    for time_, name in top[:10]:
+        print('  %-24s %6.1f' % (name, time_ / 1000))
+
+    failures = []
+    eager = [name for name in DEFERRED_MODULES if name in modules]
+    if eager:
+        failures.append('imported in stdin mode: %s' % ', '.join(eager))
+    if import_time > args.target_ms:
+        failures.append('import time %.1f ms is above the %.0f ms target' % (
+            import_time, args.target_ms))
+
+    if failures:
+        print('\nFailed: %s' % '; '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Compare the previous and current stdin paths on a psql table dump
+
+The previous `stdin_to_csv()` parsed stdin line by line into a temporary
+file, then read the whole file back to print it. Its parser is also timed
+without the spool: most of the gain comes from writing straight to stdout
+(not the block parser, which is about as fast as the line-by-line one).
+
+Usage: python benchmarks/bench_stdin.py [--size-mb 100]
+"""
+
+import io
+import os
+import sys
+import csv
+import tempfile
+import time
+
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from src import sql2csv  # noqa: E402
+
+
+def get_dump(size):
+    """ Return a psql aligned table dump of about `size` bytes """
+
+    lines = ['  id | some_int |  some_str   |      some_date',
+             '-----+----------+-------------+---------------------']
+    line = ' %3d |       12 | hello world | 2018-12-01 12:23:12'
+    count = size // len(line % 1)
+    lines.extend(line % (i % 1000) for i in range(count))
+    lines.append('(%d rows)' % count)
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def discard_line(line):
+    """ Decide whether we should keep or discard a line """
+
+    if line[:1] in ['', '+', '(', '-']:
+        return True
+
+    return False
+
+
+def remove_leading_trailing_pipe(line):
+    """ Remove optional leading and trailing pipe """
+
+    return line.strip('|')
+
+
+def get_column_separator(input_):
+    """ Return the column separator """
+
+    if input_.count('|') > input_.count('\t'):
+        return '|'
+
+    return '\t'
+
+
+def split_columns(line, separator='\t'):
+    """ Split a line with a "separator" """
+
+    return line.split(separator)
+
+
+def strip_whitespaces(tpl):
+    """ Strip white spaces before and after each item """
+
+    return [item.strip() for item in tpl]
+
+
+def parse_lines(lines, file_):
+    """ Previous parser, one line at a time (verbatim but for the names) """
+
+    writer = csv.writer(file_, delimiter=',', quotechar='"',
+                        quoting=csv.QUOTE_MINIMAL)
+
+    separator = None
+    for line in lines:
+        line.strip()
+
+        if not discard_line(line):
+            separator = get_column_separator(
+                line) if not separator else separator
+            line = remove_leading_trailing_pipe(line)
+
+            if line.strip():
+                row = split_columns(line, separator)
+                row = strip_whitespaces(row)
+                writer.writerow(row)
+
+
+def previous(dump, out):
+    """ Previous `stdin_to_csv()`: spooled to a temporary file read back whole """
+
+    lines = io.TextIOWrapper(io.BytesIO(dump), encoding='utf-8')
+    with tempfile.NamedTemporaryFile('w+', newline='', delete=False) as file_:
+        parse_lines(lines, file_)
+
+    try:
+        with open(file_.name) as f:
+            print(f.read(), file=out)
+    finally:
+        # Left behind by the previous version
+        os.remove(file_.name)
+
+
+def previous_parser(dump, out):
+    """ Previous parser only, written straight to `out` """
+
+    parse_lines(io.TextIOWrapper(io.BytesIO(dump), encoding='utf-8'), out)
+
+
+def block_based(dump, out):
+    """ `stdin_to_csv()` reading stdin in large blocks """
+
+    saved_stdin, saved_stdout = sys.stdin, sys.stdout
+    try:
+        sys.stdin = io.TextIOWrapper(io.BytesIO(dump), encoding='utf-8')
+        sys.stdout = out
+        sql2csv.stdin_to_csv()
+    finally:
+        sys.stdin, sys.stdout = saved_stdin, saved_stdout
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=100,
+                        help="Size of the generated dump in MB")
+    args = parser.parse_args()
+
+    dump = get_dump(args.size_mb * 1024 * 1024)
+    size_mb = len(dump) / 1024 / 1024
+
+    for name, function in (('previous', previous),
+                           ('previous parser, no spool', previous_parser),
+                           ('block', block_based)):
+        with open(os.devnull, 'w', newline='') as out:
+            start = time.perf_counter()
+            function(dump, out)
+            elapsed = time.perf_counter() - start
+
+        print('%-26s %.0f MB in %.2fs: %.1f MB/s' % (
+            name, size_mb, elapsed, size_mb / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the export and stdin parsing hot paths without a database server
+
+Each scenario runs in a fresh process and reports rows/sec, MB/sec and the
+peak RSS of that process. Results can be saved and compared to a baseline to
+catch regressions before a release.
+
+Usage: python benchmarks/bench_suite.py [--rows 1000000] [--stdin-size 100MB]
+                                        [--only stdin] [--save results.json]
+                                        [--baseline results.json]
+"""
+
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from decimal import Decimal
+import multiprocessing
+
+import argparse
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from src import sql2csv  # noqa: E402
+
+LONG_TEXT = 'lorem ipsum dolor sit amet, ' * 20
+
+# Column descriptions of the fake cursors, per engine
+DESCRIPTIONS = {
+    'mysql': [
+        ('id', 3, None, None, None, None, None),  # LONG
+        ('amount', 246, None, None, None, None, None),  # NEWDECIMAL
+        ('created_at', 12, None, None, None, None, None),  # DATETIME
+        ('payload', 245, None, None, None, None, None),  # JSON
+        ('body', 252, None, None, None, None, None),  # BLOB
+    ],
+    'postgresql': [
+        ('id', 23, None, None, None, None, None),  # int4
+        ('amount', 1700, None, None, None, None, None),  # numeric
+        ('created_at', 1114, None, None, None, None, None),  # timestamp
+        ('payload', 3802, None, None, None, None, None),  # jsonb
+        ('body', 25, None, None, None, None, None),  # text
+    ],
+}
+
+STDIN_FORMATS = ['mysql-batch', 'mysql-table', 'psql-aligned',
+                 'psql-unaligned', 'psql-expanded']
+
+
+class FakeCursor:
+    """ DB-API cursor returning `rows` synthetic rows of varied types """
+    """ One batch is generated up front and returned on every fetch """
+
+    def __init__(self, engine, rows, fetch_size=sql2csv.FETCH_SIZE):
+        self.description = DESCRIPTIONS[engine]
+        self.remaining = rows
+        self.batch = [
+            (i, Decimal('%d.25' % i), datetime(2018, 12, 1, 12, 23, i % 60),
+             # pymysql returns JSON columns as strings, psycopg2 decodes them
+             '{"key": %d}' % i if engine == 'mysql' else {'key': i, 'tags': ['a', 'b']},
+             LONG_TEXT[:i % len(LONG_TEXT)])
+            for i in range(fetch_size)
+        ]
+
+    def fetchmany(self, size):
+        size = min(size, len(self.batch), self.remaining)
+        self.remaining -= size
+
+        return self.batch[:size]
+
+    def close(self):
+        pass
+
+
+class CountingSink(io.RawIOBase):
+    """ Binary sink counting and discarding the bytes written """
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.bytes_written += len(b)
+        return len(b)
+
+
+def open_sink():
+    """ Return a counting sink and a text file writing to it like `open_file()` """
+
+    sink = CountingSink()
+    file_ = io.TextIOWrapper(io.BufferedWriter(sink, sql2csv.WRITE_BUFFER_SIZE),
+                             encoding='utf-8', newline='')
+
+    return sink, file_
+
+
+def get_table_rows(count):
+    """ Return rows of a table dump, with negative numbers and spaces """
+
+    return [(str(i), str(i * 7 - 500), 'hello world %d' % (i % 100),
+             '2018-12-%02d 12:23:12' % (i % 28 + 1)) for i in range(count)]
+
+
+def format_dump(format_, rows, first=True, last=True):
+    """ Render rows as `mysql` or `psql` would print them """
+    """ `first` and `last` add the header and footer of the dump """
+
+    headers = ('id', 'some_int', 'some_str', 'some_date')
+    widths = [max(len(value) for value in column)
+              for column in zip(headers, *rows)]
+    lines = []
+
+    if format_ == 'mysql-batch':
+        lines = ['\t'.join(row) for row in ([headers] if first else []) + rows]
+    elif format_ == 'mysql-table':
+        border = '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
+        lines = [border, '| ' + ' | '.join(value.ljust(width) for value, width in zip(headers, widths)) + ' |',
+                 border] if first else []
+        lines += ['| ' + ' | '.join(value.ljust(width) for value, width in zip(row, widths)) + ' |'
+                  for row in rows]
+        lines += [border] if last else []
+    elif format_ == 'psql-aligned':
+        lines = [' ' + ' | '.join(value.center(width) for value, width in zip(headers, widths)),
+                 '+'.join('-' * (width + 2) for width in widths)] if first else []
+        lines += [' ' + ' | '.join(value.rjust(width) for value, width in zip(row, widths))
+                  for row in rows]
+        lines += ['(%d rows)' % len(rows), ''] if last else []
+    elif format_ == 'psql-unaligned':
+        lines = ['|'.join(row) for row in ([headers] if first else []) + rows]
+        lines += ['(%d rows)' % len(rows)] if last else []
+    elif format_ == 'psql-expanded':
+        width = max(len(header) for header in headers)
+        for i, row in enumerate(rows):
+            lines.append('-[ RECORD %d ]---------' % (i + 1))
+            lines.extend('%s | %s' % (header.ljust(width), value)
+                         for header, value in zip(headers, row))
+
+    return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+
+class DumpStream:
+    """ Binary stream of a generated table dump of about `size` bytes """
+    """ The same block of rows is repeated, memory use does not grow with `size` """
+
+    def __init__(self, format_, size):
+        rows = get_table_rows(10000)
+        self.pieces = [format_dump(format_, rows[:1], last=False)]
+        self.body = format_dump(format_, rows, first=False, last=False)
+        self.footer = format_dump(format_, rows[:1], first=False)
+        self.blocks = max(1, size // len(self.body))
+        self.rows = self.blocks * len(rows) + 2
+        self.size = len(self.pieces[0]) + self.blocks * \
+            len(self.body) + len(self.footer)
+
+    def read(self, size=-1):
+        """ Return the next piece of the dump (up to one block of rows) """
+
+        if self.pieces:
+            return self.pieces.pop()
+        if self.blocks:
+            self.blocks -= 1
+            return self.body
+        footer, self.footer = self.footer, b''
+
+        return footer
+
+
+def bench_export(engine, rows):
+    """ `write_rows()` of synthetic typed rows to a CSV file """
+
+    sink, file_ = open_sink()
+    cursor = FakeCursor(engine, rows)
+
+    start = time.perf_counter()
+    with file_:
+        count = sql2csv.write_rows(cursor, file_, headers=True, engine=engine)
+    elapsed = time.perf_counter() - start
+
+    return count, sink.bytes_written, elapsed
+
+
+def bench_fetch_rows(engine, rows):
+    """ Row by row: `fetch_rows()`, `stringify_items()` and `writerow()` """
+
+    sink, file_ = open_sink()
+    cursor = FakeCursor(engine, rows)
+
+    start = time.perf_counter()
+    with file_:
+        writer = sql2csv.get_writer(file_)
+        count = 0
+        for row in sql2csv.fetch_rows(cursor):
+            writer.writerow(sql2csv.stringify_items(row))
+            count += 1
+    elapsed = time.perf_counter() - start
+
+    return count, sink.bytes_written, elapsed
+
+
+def bench_sqlite(rows):
+    """ `query_to_csv()` from a SQLite database file to a CSV file """
+
+    directory = tempfile.mkdtemp()
+    database = os.path.join(directory, 'bench.sqlite')
+    destination = os.path.join(directory, 'bench.csv')
+
+    # Load the table, not timed
+    connection = sqlite3.connect(database)
+    connection.execute(
+        'CREATE TABLE t (id integer, amount numeric, created_at text, payload text, body text)')
+    batch = FakeCursor('mysql', sql2csv.FETCH_SIZE).batch
+    for i in range(0, rows, len(batch)):
+        connection.executemany('INSERT INTO t VALUES (?, ?, ?, ?, ?)', [
+            (row[0] + i, str(row[1]), str(row[2]), row[3], row[4]) for row in batch[:rows - i]])
+    connection.commit()
+    connection.close()
+
+    try:
+        start = time.perf_counter()
+        sql2csv.query_to_csv(engine='sqlite', host=None, user=None, port=None,
+                             password=None, database=database, query='SELECT * FROM t',
+                             out_type='file', destination_file=destination,
+                             print_info=None)
+        elapsed = time.perf_counter() - start
+
+        return rows, os.path.getsize(destination), elapsed
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_stdin(format_, size):
+    """ `stdin_to_csv()` of a generated dump, sizes are of the input """
+
+    stream = DumpStream(format_, size)
+
+    saved_stdin, saved_stdout = sys.stdin, sys.stdout
+    try:
+        sys.stdin = stream
+        sys.stdout = open(os.devnull, 'w')
+
+        start = time.perf_counter()
+        sql2csv.stdin_to_csv(input_format=format_)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdin, sys.stdout = saved_stdin, saved_stdout
+
+    return stream.rows, stream.size, elapsed
+
+
+def run_scenario(function, args, results):
+    """ Child process: run a scenario and report its peak RSS """
+
+    rows, bytes_, elapsed = function(*args)
+    results.put({
+        'rows': rows,
+        'bytes': bytes_,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(rows / elapsed),
+        'mb_per_sec': round(bytes_ / elapsed / 1024 / 1024, 2),
+        'peak_rss_mb': round((sql2csv.get_peak_rss() or 0) / 1024 / 1024, 1),
+    })
+
+
+def get_scenarios(rows, stdin_size):
+    """ Return the list of (name, function, arguments) to run """
+
+    scenarios = []
+    for engine in ('mysql', 'postgresql'):
+        scenarios.append(('export-%s' % engine, bench_export, (engine, rows)))
+        scenarios.append(('fetch-rows-%s' % engine,
+                          bench_fetch_rows, (engine, rows)))
+    scenarios.append(('export-sqlite-file', bench_sqlite, (rows,)))
+    for format_ in STDIN_FORMATS:
+        scenarios.append(('stdin-%s' % format_,
+                          bench_stdin, (format_, stdin_size)))
+
+    return scenarios
+
+
+def compare(results, baseline, tolerance):
+    """ Return the scenarios slower than the baseline by more than `tolerance` % """
+
+    regressions = []
+    for name, result in results.items():
+        if name in baseline:
+            change = (result['rows_per_sec'] / baseline[name]['rows_per_sec'] - 1) * 100
+            result['change'] = round(change, 1)
+            if change < -tolerance:
+                regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000,
+                        help="Number of rows exported per export scenario")
+    parser.add_argument("--stdin-size", type=sql2csv.parse_size, default='100MB',
+                        help="Size of the generated stdin dumps (e.g. 1MB, 10GB)")
+    parser.add_argument("--only",
+                        help="Only run scenarios whose name contains this string")
+    parser.add_argument("--save", help="Save the results to a JSON file")
+    parser.add_argument("--baseline",
+                        help="Compare to results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=10,
+                        help="Slowdown in percent reported as a regression")
+    args = parser.parse_args()
+
+    # A fresh interpreter per scenario so peak RSS is measured in isolation
+    context = multiprocessing.get_context('spawn')
+    results = {}
+
+    print('%-28s %12s %10s %14s %10s %12s' % (
+        'scenario', 'rows', 'seconds', 'rows/sec', 'MB/sec', 'peak RSS MB'))
+    for name, function, scenario_args in get_scenarios(args.rows, args.stdin_size):
+        if args.only and args.only not in name:
+            continue
+
+        queue_ = context.Queue()
+        process = context.Process(target=run_scenario,
+                                  args=(function, scenario_args, queue_))
+        process.start()
+        result = results[name] = queue_.get()
+        process.join()
+
+        print('%-28s %12s %10.2f %14s %10.1f %12.1f' % (
+            name, "{:,}".format(result['rows']), result['seconds'],
+            "{:,}".format(result['rows_per_sec']), result['mb_per_sec'],
+            result['peak_rss_mb']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for name, result in results.items():
+            if 'change' in result:
+                print('%-28s %+.1f%% rows/sec' % (name, result['change']))
+
+        if regressions:
+            print('Regressions: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
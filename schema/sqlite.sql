@@ -0,0 +1,10 @@
+CREATE TABLE some_sqlite_table (
+    id integer PRIMARY KEY,
+    some_int integer DEFAULT NULL,
+    some_str varchar(255) DEFAULT NULL,
+    some_date datetime DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO some_sqlite_table (some_int, some_str, some_date) VALUES (12, 'hello world', '2018-12-01 12:23:12');
+INSERT INTO some_sqlite_table (some_int, some_str, some_date) VALUES (15, 'hello', '2018-12-05 12:18:12');
+INSERT INTO some_sqlite_table (some_int, some_str, some_date) VALUES (18, 'world', '2018-12-08 12:17:12');
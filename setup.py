@@ -13,8 +13,15 @@ setup(
     license='MIT',
     packages=['sql2csv'],
     package_dir={'sql2csv': 'src'},
-    install_requires=['argparse', 'PyYAML', 'pymysql',
-                      'psycopg2-binary'],  # external dependencies
+    install_requires=[],  # database drivers are extras
+    extras_require={
+        'mysql': ['pymysql'],
+        'postgresql': ['psycopg2-binary'],
+        'yaml': ['PyYAML'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'parquet': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'sql2csv = sql2csv.sql2csv:main',
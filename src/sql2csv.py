@@ -1,22 +1,168 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import io
 import csv
-import tempfile
-from os.path import expanduser
+import binascii
+import codecs
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import partial
+from itertools import chain
+from os.path import expanduser, basename, dirname, splitext
 import json
 
-import argparse
-import pymysql.cursors
-import pymysql.constants.CLIENT
-import psycopg2.extras
-import psycopg2
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 file_ = None
+FETCH_SIZE = 10000  # Default number of rows fetched per round-trip
+
+# Batch sizes chosen from a memory budget
+ADAPTIVE_FETCH_SIZE = 10  # Rows of the first fetch, before any row is measured
+MAX_FETCH_SIZE = 100000  # Larger batches no longer save round-trips
+ROW_MEMORY_FACTOR = 3  # Fetched values, converted values and encoded text
+ROW_MEMORY_OVERHEAD = 200  # Bytes of Python objects per row
+
+WRITE_BUFFER_SIZE = 1024 * 1024  # Size of the writes to compressors and part checksums
+FILE_BUFFER_SIZE = 8 * 1024 * 1024  # Size of the chunks written to destination files
+FSYNC_POLICIES = ('close', 'chunk')
+
+# Compression inferred from the destination file extension
+COMPRESSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+    '.lz4': 'lz4',
+}
+
+ROW_GROUP_SIZE = 100000  # Default number of rows per Parquet/Arrow batch
+STDIN_BLOCK_SIZE = 1024 * 1024  # Size of the blocks read from stdin
+STDIN_SNIFF_LINES = 50  # Lines inspected to detect the stdin format
+
+# Patterns of the psql rule line, expanded record header and footer
+PSQL_RULE = re.compile(r'-+(\+-+)*$')
+PSQL_RECORD = re.compile(r'-\[ RECORD \d+ \]')
+PSQL_FOOTER = re.compile(r'\(\d+ rows?\)$')
+
+FORMAT_CACHE_SIZE = 10000  # Formatted values cached per low-cardinality column
+FORMAT_CACHE_SAMPLE = 100  # Fewest first batch values telling a low-cardinality column
+CHECKPOINT_ROWS = 100000  # Rows written between two checkpoints of a resumable export
+CACHE_TTL = 300  # Seconds a cached result is served for
+CACHE_SIZE = 1024 ** 3  # Total size of the result cache before eviction
+
+# `query_to_csv()` arguments that change the cached result
+CACHE_KEY_ARGS = ('engine', 'host', 'port', 'user', 'database', 'query', 'headers',
+                  'delimiter', 'quotechar', 'native_copy', 'format_', 'row_group_size',
+                  'datetime_format', 'binary_format', 'raw')
+
+CONNECTION_KEYS = ('engine', 'host', 'port', 'user', 'password', 'database')
+
+# Serializes updates of watermark state files shared by concurrent jobs
+WATERMARK_LOCK = threading.Lock()
+
+# Column type codes mapped to Arrow types, per engine
+ARROW_TYPES = {
+    'mysql': {
+        1: 'int64',  # TINY
+        2: 'int64',  # SHORT
+        3: 'int64',  # LONG
+        9: 'int64',  # INT24
+        8: 'int64',  # LONGLONG
+        13: 'int64',  # YEAR
+        4: 'float64',  # FLOAT
+        5: 'float64',  # DOUBLE
+        0: 'decimal',  # DECIMAL
+        246: 'decimal',  # NEWDECIMAL
+        10: 'date32',  # DATE
+        14: 'date32',  # NEWDATE
+        12: 'timestamp',  # DATETIME
+        7: 'timestamp',  # TIMESTAMP
+        11: 'duration',  # TIME
+        15: 'string',  # VARCHAR
+        253: 'string',  # VAR_STRING
+        254: 'string',  # STRING
+        247: 'string',  # ENUM
+        248: 'string',  # SET
+        245: 'string',  # JSON
+    },
+    'postgresql': {
+        16: 'bool_',  # bool
+        17: 'binary',  # bytea
+        20: 'int64',  # int8
+        21: 'int64',  # int2
+        23: 'int64',  # int4
+        26: 'int64',  # oid
+        700: 'float64',  # float4
+        701: 'float64',  # float8
+        1700: 'decimal',  # numeric
+        1082: 'date32',  # date
+        1083: 'time64',  # time
+        1114: 'timestamp',  # timestamp
+        1184: 'timestamptz',  # timestamptz
+        1186: 'duration',  # interval
+        19: 'string',  # name
+        25: 'string',  # text
+        1042: 'string',  # bpchar
+        1043: 'string',  # varchar
+        114: 'string',  # json
+        3802: 'string',  # jsonb
+        2950: 'string',  # uuid
+    },
+}
+
+# MySQL column types, to build the CSV lines of a native export
+MYSQL_NUMERIC_TYPES = frozenset([
+    0,  # DECIMAL
+    246,  # NEWDECIMAL
+    1,  # TINY
+    2,  # SHORT
+    3,  # LONG
+    9,  # INT24
+    8,  # LONGLONG
+    4,  # FLOAT
+    5,  # DOUBLE
+    13,  # YEAR
+])
+MYSQL_TEMPORAL_TYPES = frozenset([
+    10,  # DATE
+    14,  # NEWDATE
+    11,  # TIME
+    12,  # DATETIME
+    7,  # TIMESTAMP
+])
+
+# Column type codes that can hold JSON values, per engine
+JSON_TYPES = {
+    'mysql': {245},  # JSON
+    'postgresql': {114, 3802},  # json, jsonb
+}
+
+
+def get_mysql_connection(host, user, port, password, database, raw=False):
+    """ MySQL connection """
+    """ With `raw`, values are not decoded: text columns come as strings """
+    """ and binary columns as bytes """
 
+    # Drivers are imported on first use to keep the CLI startup fast
+    try:
+        import pymysql
+    except ImportError:
+        raise RuntimeError(
+            'The "mysql" engine requires the "pymysql" package.')
 
-def get_mysql_connection(host, user, port, password, database):
-    """ MySQL connection """
+    # Conversions without decoders: values are kept as sent by MySQL
+    conv = None
+    if raw:
+        conv = {key: value for key, value in pymysql.converters.conversions.items()
+                if not isinstance(key, int)}
 
     return pymysql.connect(host=host,
                            user=user,
@@ -24,50 +170,673 @@ def get_mysql_connection(host, user, port, password, database):
                            password=password,
                            db=database,
                            charset='utf8mb4',
-                           client_flag=pymysql.constants.CLIENT.MULTI_STATEMENTS
+                           client_flag=pymysql.constants.CLIENT.MULTI_STATEMENTS,
+                           conv=conv
                            )
 
 
-def get_pg_connection(host, user, port, password, database):
+def cast_raw(value, cursor):
+    """ psycopg2 typecaster returning a value as PostgreSQL sent it """
+
+    return value
+
+
+def get_pg_connection(host, user, port, password, database, raw=False):
     """ PostgreSQL connection """
+    """ With `raw`, values of every built-in type come as strings """
+
+    try:
+        import psycopg2
+        import psycopg2.extensions
+    except ImportError:
+        raise RuntimeError(
+            'The "postgresql" engine requires the "psycopg2" package.')
+
+    connection = psycopg2.connect(host=host,
+                                  user=user,
+                                  port=port,
+                                  password=password,
+                                  dbname=database
+                                  )
+
+    if raw:
+        psycopg2.extensions.register_type(psycopg2.extensions.new_type(
+            tuple(psycopg2.extensions.string_types), 'RAW', cast_raw), connection)
+
+    return connection
+
+
+def get_sqlite_connection(host, user, port, password, database):
+    """ SQLite connection, `database` is the path of the database file """
+
+    # Imported on first use like the other drivers
+    import sqlite3
+
+    class SQLiteCursor(sqlite3.Cursor):
+        """ SQLite cursor accepting the `%s` placeholders used with other engines """
 
-    return psycopg2.connect(host=host,
-                            user=user,
-                            port=port,
-                            password=password,
-                            dbname=database
-                            )
+        def execute(self, query, params=None):
+            if params is None:
+                return super().execute(query)
 
+            # `%s` becomes `?` and `%%` an escaped `%`
+            query = re.sub(r'%([s%])',
+                           lambda match: '?' if match.group(1) == 's' else '%', query)
 
-def get_connection(engine, host, user, port, password, database):
+            return super().execute(query, params)
+
+    class SQLiteConnection(sqlite3.Connection):
+        """ SQLite connection returning `SQLiteCursor` cursors """
+
+        def cursor(self, factory=SQLiteCursor):
+            return super().cursor(factory)
+
+    return sqlite3.connect(resolve_home_dir(database), factory=SQLiteConnection,
+                           check_same_thread=False)
+
+
+def get_connection(engine, host, user, port, password, database, raw=False):
     """ Get SQL connection """
+    """ With `raw`, the driver returns values as text instead of decoding them """
+
+    if raw:
+        if not get_engine(engine).raw:
+            raise RuntimeError(
+                'Raw values are not supported by the "%s" engine.' % (engine))
+
+        return get_engine(engine).connect(host, user, port, password, database, raw=True)
 
-    if engine == 'mysql':
-        return get_mysql_connection(host, user, port, password, database)
-    elif engine == 'postgresql':
-        return get_pg_connection(host, user, port, password, database)
+    return get_engine(engine).connect(host, user, port, password, database)
+
+
+def ping_mysql_connection(connection):
+    """ Check a MySQL connection without running a query """
+
+    connection.ping(reconnect=False)
+
+
+def ping_connection(connection, engine):
+    """ Return `True` if an open connection still answers """
+
+    try:
+        ping = get_engine(engine).ping
+        if ping:
+            ping(connection)
+        else:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            connection.rollback()
+    except Exception:
+        return False
+
+    return True
+
+
+class ConnectionPool:
+    """ Keep connections open between queries, keyed by engine, host, port, user, database and raw mode """
+    """ Idle connections are closed after `idle_timeout` seconds and pinged before reuse """
+
+    def __init__(self, max_size=4, idle_timeout=300, health_check=True):
+        self.max_size = max_size  # Per key
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.idle = {}  # Key: [(connection, released at), ...]
+        self.in_use = {}  # Key: number of connections handed out
+        self.keys = {}  # id(connection): key
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def acquire(self, engine, host, user, port, password, database, raw=False):
+        """ Return an idle connection or open a new one """
+        """ Blocks while `max_size` connections of the same key are in use """
+
+        key = (engine, host, port, user, database, raw)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The connection pool is closed.')
+
+            self.close_expired()
+            while not self.idle.get(key) and self.in_use.get(key, 0) >= self.max_size:
+                self.condition.wait()
+            connection = self.idle[key].pop()[0] if self.idle.get(key) else None
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+
+        try:
+            if connection is not None and self.health_check and not ping_connection(connection, engine):
+                self.close_connection(connection)
+                connection = None
+            if connection is None:
+                connection = get_connection(engine=engine, host=host, user=user, port=port,
+                                            password=password, database=database, raw=raw)
+        except Exception:
+            with self.condition:
+                self.in_use[key] -= 1
+                self.condition.notify()
+            raise
+
+        self.keys[id(connection)] = key
+
+        return connection
+
+    def release(self, connection, discard=False):
+        """ Return a connection to the pool, its transaction is rolled back """
+        """ Connections that are discarded or fail to roll back are closed """
+
+        key = self.keys.pop(id(connection))
+        if not discard:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+
+        with self.condition:
+            self.in_use[key] -= 1
+            if discard or self.closed:
+                self.close_connection(connection)
+            else:
+                self.idle.setdefault(key, []).append(
+                    (connection, time.monotonic()))
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self, **kwargs):
+        """ Acquire a connection and release it on exit """
+        """ The connection is discarded if an exception is raised """
+
+        connection = self.acquire(**kwargs)
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, discard=True)
+            raise
+
+        self.release(connection)
+
+    def close_expired(self):
+        """ Close connections idle for more than `idle_timeout` seconds """
+
+        deadline = time.monotonic() - self.idle_timeout
+        for key, idle in self.idle.items():
+            for connection, released_at in idle:
+                if released_at < deadline:
+                    self.close_connection(connection)
+            self.idle[key] = [item for item in idle if item[1] >= deadline]
+
+    def close(self):
+        """ Close idle connections, connections in use are closed on release """
+
+        with self.condition:
+            self.closed = True
+            for idle in self.idle.values():
+                for connection, _ in idle:
+                    self.close_connection(connection)
+            self.idle = {}
+
+    @staticmethod
+    def close_connection(connection):
+        """ Close a connection, ignoring errors from a broken one """
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+@contextmanager
+def borrow_connection(connection=None, pool=None, **kwargs):
+    """ Yield `connection`, a connection from `pool` or a new connection """
+    """ New connections are closed on exit, pooled connections are released """
+
+    if connection is not None:
+        yield connection
+    elif pool is not None:
+        with pool.connection(**kwargs) as connection:
+            yield connection
     else:
-        raise RuntimeError(
-            '"%s" engine is not supported.' % (engine))
+        connection = get_connection(**kwargs)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+
+def get_mysql_cursor(connection):
+    """ MySQL unbuffered (streaming) cursor """
+
+    import pymysql.cursors
+
+    return connection.cursor(pymysql.cursors.SSCursor)
+
+
+def get_pg_cursor(connection):
+    """ PostgreSQL server-side (named) cursor """
+
+    return connection.cursor(name='sql2csv')
 
 
-def get_cursor(connection):
+def get_cursor(connection, engine=None):
     """ Return connection cursor """
+    """ The engine streaming cursor is used when `engine` is set """
+
+    get_engine_cursor = get_engine(engine).get_cursor if engine else None
+    if get_engine_cursor:
+        return get_engine_cursor(connection)
 
     return connection.cursor()
 
 
-def execute_query(cursor, query):
+def start_mysql_snapshot(connection, snapshot=None):
+    """ Start a MySQL consistent snapshot transaction """
+
+    cursor = connection.cursor()
+    cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+    cursor.close()
+
+
+def lock_mysql_writes(connection):
+    """ Block commits on the MySQL server until `unlock_mysql_writes()` """
+    """ Snapshots started meanwhile by other connections see the same data """
+
+    cursor = connection.cursor()
+    cursor.execute('FLUSH TABLES WITH READ LOCK')
+    cursor.close()
+
+
+def unlock_mysql_writes(connection):
+    """ Release the lock taken by `lock_mysql_writes()` """
+
+    cursor = connection.cursor()
+    cursor.execute('UNLOCK TABLES')
+    cursor.close()
+
+
+def start_pg_snapshot(connection, snapshot=None):
+    """ Start a PostgreSQL read-only repeatable read transaction """
+    """ It joins `snapshot` when exported by another connection """
+
+    connection.set_session(
+        isolation_level='REPEATABLE READ', readonly=True)
+    if snapshot:
+        cursor = connection.cursor()
+        cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+        cursor.close()
+
+
+def export_pg_snapshot(connection):
+    """ Return the identifier of the current PostgreSQL snapshot """
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_export_snapshot()')
+    snapshot = cursor.fetchone()[0]
+    cursor.close()
+
+    return snapshot
+
+
+def start_snapshot(connection, engine, snapshot=None):
+    """ Start a consistent read-only transaction """
+    """ PostgreSQL can join a `snapshot` exported by another connection """
+
+    start_engine_snapshot = get_engine(engine).start_snapshot
+    if start_engine_snapshot:
+        start_engine_snapshot(connection, snapshot=snapshot)
+
+
+def export_snapshot(connection, engine):
+    """ Start a consistent transaction and return its snapshot identifier """
+    """ Only PostgreSQL can share a snapshot, `None` is returned otherwise """
+
+    start_snapshot(connection, engine)
+
+    export_engine_snapshot = get_engine(engine).export_snapshot
+    if export_engine_snapshot:
+        return export_engine_snapshot(connection)
+
+    return None
+
+
+def start_shared_snapshot(connection, connections, engine):
+    """ Start consistent transactions seeing the same data on all connections """
+    """ PostgreSQL `connections` join the snapshot exported by `connection`, """
+    """ MySQL writes are blocked by `connection` while their snapshots start """
+
+    lock_writes = get_engine(engine).lock_writes
+    if lock_writes:
+        lock_writes(connection)
+
+    try:
+        snapshot = export_snapshot(connection, engine)
+        for other in connections:
+            start_snapshot(other, engine, snapshot=snapshot)
+    finally:
+        if lock_writes:
+            get_engine(engine).unlock_writes(connection)
+
+
+def execute_query(cursor, query, params=None):
     """ Run a query and yield each row """
 
-    cursor.execute(query)
+    cursor.execute(query, params)
+
+
+def wrap_query(query, conditions=None):
+    """ Filter the result of a query used as a derived table """
+    """ The returned query must be executed with parameters """
+
+    query = 'SELECT * FROM (%s) AS sql2csv_src' % (
+        query.strip().rstrip(';').replace('%', '%%'))
+
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    return query
+
+
+def get_split_bounds(cursor, query, column):
+    """ Return the minimum and maximum values of a column """
+
+    cursor.execute('SELECT MIN(%s), MAX(%s) FROM (%s) AS sql2csv_src' % (
+        column, column, query.strip().rstrip(';')))
+
+    return cursor.fetchone()
+
+
+def split_range(low, high, chunks):
+    """ Return up to `chunks - 1` boundaries splitting a range evenly """
+
+    try:
+        span = high - low
+    except TypeError:
+        span = None
+
+    if not isinstance(span, (int, float, Decimal, timedelta)):
+        raise RuntimeError(
+            'The split column must be a numeric or date column.')
+
+    boundaries = []
+    for i in range(1, chunks):
+        step = span * i
+        boundary = low + (step // chunks if isinstance(step, int)
+                          else step / chunks)
+
+        if low < boundary and boundary not in boundaries:
+            boundaries.append(boundary)
+
+    return boundaries
+
+
+def get_chunk_filters(column, boundaries):
+    """ Return a list of (conditions, params) covering each chunk """
+    """ The first chunk also holds rows where the column is NULL """
+
+    bounds = [None] + boundaries + [None]
+    filters = []
+    for start, end in zip(bounds, bounds[1:]):
+        conditions, params = [], []
+        if start is not None:
+            conditions.append('%s >= %%s' % (column))
+            params.append(start)
+        if end is not None:
+            conditions.append('%s < %%s' % (column))
+            params.append(end)
+        if start is None and end is not None:
+            conditions = ['(%s OR %s IS NULL)' % (conditions[0], column)]
+
+        filters.append((conditions, tuple(params)))
 
+    return filters
 
-def fetch_rows(cursor):
+
+def quote_literal(value):
+    """ Quote a string as a SQL literal """
+
+    return "'%s'" % value.replace("'", "''")
+
+
+def get_copy_query(query, headers=False, delimiter=',', quotechar='"'):
+    """ Wrap a query in a PostgreSQL `COPY ... TO STDOUT` statement """
+
+    return 'COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER %s, DELIMITER %s, QUOTE %s)' % (
+        query.strip().rstrip(';'),
+        'true' if headers else 'false',
+        quote_literal(delimiter),
+        quote_literal(quotechar)
+    )
+
+
+def copy_to_csv(cursor, query, file_, headers=False, delimiter=',', quotechar='"', metrics=None):
+    """ Stream a query result as CSV generated by PostgreSQL """
+    """ The COPY is timed as a fetch and its output counted when `metrics` is set """
+
+    with timed(metrics, 'fetch'):
+        cursor.copy_expert(
+            get_copy_query(query, headers=headers,
+                           delimiter=delimiter, quotechar=quotechar),
+            CountingFile(file_, metrics) if metrics else file_
+        )
+
+    # The row count is read from the COPY command tag
+    if metrics and cursor.rowcount > 0:
+        metrics.add_rows(cursor.rowcount)
+
+
+def get_mysql_copy_query(query, fields, escape, delimiter=',', quotechar='"'):
+    """ Wrap a query so that MySQL returns each row as a single CSV line """
+    """ `fields` are the pymysql fields of the result, `escape` quotes a literal """
+
+    delimiter_literal, quote_literal_ = escape(delimiter), escape(quotechar)
+
+    # Numbers and dates never need quotes, unless the delimiter could be in them
+    plain_types = MYSQL_NUMERIC_TYPES | MYSQL_TEMPORAL_TYPES
+
+    # Numbers, dates and JSON also report the binary charset, but are text
+    text_types = MYSQL_NUMERIC_TYPES | MYSQL_TEMPORAL_TYPES | JSON_TYPES['mysql']
+    if set(delimiter + quotechar) & set('0123456789.-+eE: '):
+        plain_types = frozenset()
+
+    columns = []
+    for field in fields:
+        column = 'sql2csv_src.`%s`' % (field.name.replace('`', '``'))
+        if field.charsetnr == 63 and field.type_code not in text_types:
+            # Binary values (BLOB, BINARY, BIT, GEOMETRY...) are written as
+            # hex, like `format_binary()`: quoting them would make the whole
+            # line a binary string, returned as bytes
+            column = 'LOWER(HEX(%s))' % (column)
+        elif field.type_code not in plain_types:
+            # Quote like `csv.writer` (QUOTE_MINIMAL)
+            column = 'IF(LOCATE(%(d)s, %(c)s) OR LOCATE(%(q)s, %(c)s) OR LOCATE(CHAR(13), %(c)s) OR LOCATE(CHAR(10), %(c)s), CONCAT(%(q)s, REPLACE(%(c)s, %(q)s, CONCAT(%(q)s, %(q)s)), %(q)s), %(c)s)' % {
+                'c': column, 'd': delimiter_literal, 'q': quote_literal_}
+
+        # `CONCAT_WS()` skips NULL values, they are written as empty fields
+        columns.append("IFNULL(%s, '')" % (column))
+
+    return 'SELECT CONCAT_WS(%s, %s) FROM (%s) AS sql2csv_src' % (
+        delimiter_literal, ', '.join(columns), query.strip().rstrip(';'))
+
+
+def mysql_copy_to_csv(cursor, query, file_, headers=False, delimiter=',', quotechar='"', fetch_size=FETCH_SIZE, metrics=None):
+    """ Stream a query result as CSV lines generated by MySQL """
+    """ The client reads one string per row instead of decoding every field """
+
+    # An empty result gives the columns and their types
+    cursor.execute('SELECT * FROM (%s) AS sql2csv_src LIMIT 0' %
+                   (query.strip().rstrip(';')))
+    # `cursor.description` has no charset, which tells binary values from
+    # text (BLOB and TEXT share their type codes): pymysql only keeps it in
+    # the fields of the result
+    fields = cursor._result.fields
+    names = [field.name for field in fields]
+    if len(set(names)) < len(names):
+        raise RuntimeError(
+            'Native export requires unique column names, use aliases.')
+
+    if headers:
+        get_writer(file_, delimiter=delimiter, quotechar=quotechar,
+                   lineterminator='\n').writerow(names)
+
+    lines = get_mysql_cursor(cursor.connection)
+    lines.execute(get_mysql_copy_query(query, fields, cursor.connection.escape,
+                                       delimiter=delimiter, quotechar=quotechar))
+    for rows in fetch_batches(lines, fetch_size=fetch_size, metrics=metrics):
+        text = '\n'.join([row[0] for row in rows]) + '\n'
+        with timed(metrics, 'write'):
+            file_.write(text)
+        if metrics:
+            metrics.add_bytes(text)
+    lines.close()
+
+
+class Engine:
+    """ How to connect to a database, stream its rows and map its column types """
+    """ Optional features are left to `None` when the engine does not have them """
+
+    def __init__(self, name, connect, get_cursor=None, server=True, default_port=None, start_snapshot=None, export_snapshot=None, lock_writes=None, unlock_writes=None, copy_to_csv=None, ping=None, json_types=frozenset(), arrow_types=None, raw=False):
+        self.name = name
+        self.connect = connect  # (host, user, port, password, database)
+        self.get_cursor = get_cursor  # (connection), a streaming cursor
+        self.server = server  # `False` if host, port and user do not apply
+        self.default_port = default_port
+        self.start_snapshot = start_snapshot  # (connection, snapshot=None)
+        self.export_snapshot = export_snapshot  # (connection), a snapshot to share
+        self.lock_writes = lock_writes  # (connection), to start snapshots that cannot be shared
+        self.unlock_writes = unlock_writes  # (connection)
+        self.copy_to_csv = copy_to_csv  # Native bulk export, see `copy_to_csv()`
+        self.ping = ping  # (connection), `SELECT 1` if not set
+        self.json_types = json_types  # Type codes of columns holding JSON values
+        self.arrow_types = arrow_types or {}  # Type codes: `ARROW_TYPES` names
+        self.raw = raw  # `True` if `connect` accepts `raw=True` (values as text)
+
+
+ENGINES = {}
+
+
+def register_engine(engine):
+    """ Make an `Engine` available by its name """
+
+    ENGINES[engine.name] = engine
+
+
+def load_engine_plugins():
+    """ Register the engines of the `sql2csv.engines` entry point group """
+    """ An entry point refers to an `Engine` or a function returning one """
+
+    try:
+        from importlib.metadata import entry_points
+        found = entry_points()
+        if hasattr(found, 'select'):
+            found = found.select(group='sql2csv.engines')
+        else:
+            found = found.get('sql2csv.engines', [])
+    except ImportError:  # Python < 3.8
+        try:
+            import pkg_resources
+        except ImportError:
+            return
+        found = pkg_resources.iter_entry_points('sql2csv.engines')
+
+    for entry_point in found:
+        if entry_point.name not in ENGINES:
+            engine = entry_point.load()
+            register_engine(engine if isinstance(engine, Engine) else engine())
+
+
+def get_engine(name):
+    """ Return a registered `Engine` """
+
+    if name not in ENGINES:
+        load_engine_plugins()
+    if name not in ENGINES:
+        raise RuntimeError(
+            '"%s" engine is not supported.' % (name))
+
+    return ENGINES[name]
+
+
+register_engine(Engine(
+    'mysql',
+    get_mysql_connection,
+    get_cursor=get_mysql_cursor,
+    default_port=3306,
+    start_snapshot=start_mysql_snapshot,
+    lock_writes=lock_mysql_writes,
+    unlock_writes=unlock_mysql_writes,
+    copy_to_csv=mysql_copy_to_csv,
+    ping=ping_mysql_connection,
+    json_types=JSON_TYPES['mysql'],
+    arrow_types=ARROW_TYPES['mysql'],
+    raw=True
+))
+register_engine(Engine(
+    'postgresql',
+    get_pg_connection,
+    get_cursor=get_pg_cursor,
+    default_port=5432,
+    start_snapshot=start_pg_snapshot,
+    export_snapshot=export_pg_snapshot,
+    copy_to_csv=copy_to_csv,
+    json_types=JSON_TYPES['postgresql'],
+    arrow_types=ARROW_TYPES['postgresql'],
+    raw=True
+))
+# SQLite cursors fetch rows lazily, no streaming cursor is needed
+register_engine(Engine('sqlite', get_sqlite_connection, server=False))
+
+
+class FetchSizer:
+    """ Number of rows to fetch so that a batch fits in `memory_budget` bytes """
+    """ Sized from the average encoded row size of the batches written """
+
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.size = ADAPTIVE_FETCH_SIZE
+        self.row_bytes = None
+
+    def observe(self, rows, size):
+        """ Resize after a batch of `rows` rows was encoded to `size` bytes """
+
+        if not rows:
+            return
+
+        # Weighted towards the last batch to follow changes of row width
+        row_bytes = size / rows
+        if self.row_bytes is not None:
+            row_bytes = (self.row_bytes + row_bytes) / 2
+        self.row_bytes = row_bytes
+
+        target = int(self.memory_budget / (
+            ROW_MEMORY_FACTOR * row_bytes + ROW_MEMORY_OVERHEAD))
+
+        # Shrink at once, grow by 4x at most per batch
+        self.size = max(1, min(target, self.size * 4, MAX_FETCH_SIZE))
+
+
+def fetch_batches(cursor, fetch_size=FETCH_SIZE, metrics=None, sizer=None):
+    """ Fetch and yield lists of up to `fetch_size` rows """
+    """ Fetch time and row counts are added to `metrics` when set """
+    """ The size of each fetch is read from `sizer` when set """
+
+    while True:
+        if sizer:
+            fetch_size = sizer.size
+        if metrics:
+            with metrics.timer('fetch'):
+                rows = cursor.fetchmany(fetch_size)
+            metrics.add_rows(len(rows))
+        else:
+            rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+
+        yield rows
+
+
+def fetch_rows(cursor, fetch_size=FETCH_SIZE):
     """ Fetch and yield rows """
 
-    for row in cursor.fetchall():
-        yield row
+    for rows in fetch_batches(cursor, fetch_size=fetch_size):
+        for row in rows:
+            yield row
 
 
 def fetch_headers(cursor):
@@ -76,52 +845,337 @@ def fetch_headers(cursor):
     return [i[0] for i in cursor.description]
 
 
-def discard_line(line):
-    """ Decide whether we should keep or discard a line """
+def sniff_format(lines):
+    """ Guess the format of a `mysql` or `psql` dump from its first lines """
+    """ Only the first `STDIN_SNIFF_LINES` non-empty lines are inspected """
 
-    if line[:1] in ['', '+', '(', '-']:
-        return True
+    lines = [line.rstrip('\r') for line in lines[:STDIN_SNIFF_LINES]]
+    lines = [line for line in lines if line]
+    if not lines:
+        return 'mysql-batch'
 
-    return False
+    # `+----+` borders (mysql table, psql with `\pset border 2`)
+    if lines[0][:2] == '+-':
+        return 'mysql-table'
+
+    # `-[ RECORD 1 ]---` blocks (psql `\x`)
+    if PSQL_RECORD.match(lines[0]):
+        return 'psql-expanded'
+
+    # Header followed by a `----+----` rule (psql default)
+    if len(lines) > 1 and PSQL_RULE.match(lines[1]):
+        return 'psql-aligned'
+
+    # Tab separated (mysql batch mode, used when stdout is not a terminal)
+    if '\t' in lines[0]:
+        return 'mysql-batch'
+
+    # `|` separated or `(n rows)` footer (psql -A)
+    if '|' in lines[0] or any(PSQL_FOOTER.match(line) for line in lines):
+        return 'psql-unaligned'
+
+    return 'mysql-batch'
+
+
+def parse_mysql_batch(blocks):
+    """ Parse `mysql --batch` output: tab separated, no borders """
+
+    for lines in blocks:
+        yield [line.rstrip('\r').split('\t') for line in lines if line]
+
+
+def parse_mysql_table(blocks):
+    """ Parse `mysql --table` output: rows framed by `|` and `+---+` borders """
+
+    for lines in blocks:
+        yield [[item.strip() for item in line.rstrip('\r')[1:-1].split('|')]
+               for line in lines if line[:1] == '|']
 
 
-def remove_leading_trailing_pipe(line):
-    """ Remove optional leading and trailing pipe """
+def parse_psql_aligned(blocks):
+    """ Parse `psql` aligned output """
+    """ Header and rows start with a padding space, the rule and footer do not """
 
-    return line.strip('|')
+    for lines in blocks:
+        yield [[item.strip() for item in line.rstrip('\r').split('|')]
+               for line in lines if line[:1] == ' ']
 
 
-def get_column_separator(input_):
-    """ Return the column separator """
-    """ This logic needs to be improved """
+def parse_psql_unaligned(blocks):
+    """ Parse `psql -A` output: `|` separated, `(n rows)` footer """
 
-    if input_.count('|') > input_.count('\t'):
-        return '|'
+    for lines in blocks:
+        yield [line.rstrip('\r').split('|') for line in lines
+               if line and (line[:1] != '(' or not PSQL_FOOTER.match(line))]
 
-    return '\t'
 
+def parse_psql_expanded(blocks):
+    """ Parse `psql -x` output: one `-[ RECORD n ]` block per row """
+    """ Headers are taken from the first record """
 
-def split_columns(line, separator='\t'):
-    """ Split a line with a "separator" """
+    headers, record, count = [], None, 0
+    for lines in blocks:
+        rows = []
+        for line in lines:
+            if line[:2] == '-[':
+                if record is not None:
+                    rows.append(record)
+                record, count = [], count + 1
+            elif record is not None and '|' in line:
+                key, _, value = line.rstrip('\r').partition('|')
+                record.append(value.strip())
+                if count == 1:
+                    headers.append(key.strip())
 
-    return line.split(separator)
+        # The first record is complete, headers go first
+        if rows and headers is not None:
+            rows.insert(0, headers)
+            headers = None
 
+        yield rows
 
-def strip_whitespaces(tpl):
-    """ Strip white spaces before and after each item """
+    if record is not None:
+        yield [headers, record] if headers is not None else [record]
 
-    return [item.strip() for item in tpl]
+
+STDIN_PARSERS = {
+    'mysql-batch': parse_mysql_batch,
+    'mysql-table': parse_mysql_table,
+    'psql-aligned': parse_psql_aligned,
+    'psql-unaligned': parse_psql_unaligned,
+    'psql-expanded': parse_psql_expanded,
+}
+
+
+def read_lines(stream, block_size=STDIN_BLOCK_SIZE):
+    """ Read a stream in large blocks and yield lists of lines """
+
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    remainder = ''
+    while True:
+        raw = stream.read(block_size)
+        block = raw
+        if isinstance(raw, bytes):
+            block = decoder.decode(raw, final=not raw)
+
+        lines = (remainder + block).split('\n')
+        remainder = lines.pop()
+        if lines:
+            yield lines
+
+        if not raw:
+            break
+
+    if remainder:
+        yield [remainder]
+
+
+def stringify_item(item):
+    """ Json-encode an item if it is a dict """
+
+    if isinstance(item, dict):
+        return json.dumps(item)
+
+    return item
+
+
+def format_json(item):
+    """ Json-encode the objects and arrays of a JSON column """
+    """ Lists of other columns (PostgreSQL arrays) are left to `str()` """
+
+    if isinstance(item, (dict, list)):
+        return json.dumps(item)
+
+    return item
 
 
 def stringify_items(row):
     """ Loop thru each item and Json-encode dicts """
 
-    row = list(row)
-    for k, item in enumerate(row):
-        if (isinstance(item, dict)):
-            row[k] = json.dumps(item)
+    return tuple(stringify_item(item) for item in row)
+
+
+def format_datetime(item, datetime_format=None):
+    """ Format a datetime with `strftime()`, or as `str()` does (ISO 8601) """
+
+    if isinstance(item, datetime):
+        return item.strftime(datetime_format) if datetime_format else str(item)
+
+    return item
+
+
+def format_date(item):
+    """ Format a date as YYYY-MM-DD """
+
+    if isinstance(item, date):
+        return item.isoformat()
+
+    return item
+
+
+def format_decimal(item):
+    """ Format a decimal with its own scale and without an exponent """
+    """ (`str()` turns `Decimal('0.00000001')` into "1E-8") """
+
+    if isinstance(item, Decimal):
+        return format(item, 'f')
+
+    return item
+
+
+def format_binary(item, binary_format='hex'):
+    """ Encode binary data as hex or base64 text """
 
-    return tuple(row)
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        if binary_format == 'base64':
+            return binascii.b2a_base64(item, newline=False).decode('ascii')
+        return bytes(item).hex()
+
+    return item
+
+
+def format_item(item, datetime_format=None, binary_format='hex'):
+    """ Format a value of a column whose first batch only held NULL values """
+
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return format_binary(item, binary_format=binary_format)
+    elif isinstance(item, dict):
+        return stringify_item(item)
+    elif isinstance(item, Decimal):
+        return format_decimal(item)
+    elif datetime_format and isinstance(item, datetime):
+        return format_datetime(item, datetime_format=datetime_format)
+
+    return item
+
+
+class FormatCache(dict):
+    """ Formatted values of a low-cardinality column, keyed by value """
+    """ Its `__getitem__` is the converter: hits never call Python code """
+    """ Only for values that print the same when equal (not decimals, whose """
+    """ scale is lost, or aware datetimes, whose offset is) """
+
+    def __init__(self, formatter, max_size=FORMAT_CACHE_SIZE):
+        self.formatter = formatter
+        self.max_size = max_size
+
+    def __missing__(self, item):
+        text = self.formatter(item)
+        if len(self) >= self.max_size:
+            self.clear()
+        self[item] = text
+
+        return text
+
+
+def get_column_kind(values):
+    """ Return the kind of column from the type of its first non-null value """
+
+    for item in values:
+        if item is None:
+            continue
+        elif isinstance(item, datetime):
+            return 'timestamp'
+        elif isinstance(item, date):
+            return 'date32'
+        elif isinstance(item, Decimal):
+            return 'decimal'
+        elif isinstance(item, (bytes, bytearray, memoryview)):
+            return 'binary'
+        elif isinstance(item, dict):
+            return 'json'
+        elif isinstance(item, str):
+            return 'string'
+        return None
+
+
+def get_formatter(kind, datetime_format=None, binary_format='hex'):
+    """ Return the formatter of a kind of column, `None` if `str()` is right """
+
+    if kind in ('timestamp', 'timestamptz'):
+        return partial(format_datetime, datetime_format=datetime_format)
+    elif kind == 'date32':
+        return format_date
+    elif kind == 'decimal':
+        return format_decimal
+    elif kind == 'binary':
+        return partial(format_binary, binary_format=binary_format)
+    elif kind == 'json':
+        return format_json
+
+
+def get_converters(cursor, engine=None, rows=None, datetime_format=None, binary_format='hex', raw=False):
+    """ Return a converter per column, `None` if the column needs none """
+    """ Formatters are chosen from the column type codes, else from the """
+    """ values of the first batch of `rows`, which also tell columns the """
+    """ driver returns as text. Unknown engines check every remaining """
+    """ column for dicts, and columns of unknown type with only NULL values """
+    """ in `rows` check each value. With `raw`, typed columns returned as """
+    """ text need no converter. The plan stays correct for a small first """
+    """ batch, which only gives up caching repeated values """
+
+    engine = ENGINES.get(engine)
+    columns = list(zip(*rows)) if rows else []
+
+    converters = []
+    for k, column in enumerate(cursor.description or []):
+        if engine and column[1] in engine.json_types:
+            kind = 'json'
+        else:
+            kind = engine.arrow_types.get(column[1]) if engine else None
+
+        # MySQL binary strings (BLOB and TEXT share the type codes 249-252)
+        # and SQLite columns are only told by their values
+        values = columns[k] if columns else ()
+        found = get_column_kind(values)
+        if kind in (None, 'string'):
+            if columns and all(item is None for item in values):
+                # Not settled by the first batch: each value is checked
+                converters.append(partial(format_item, datetime_format=datetime_format,
+                                          binary_format=binary_format))
+                continue
+            kind = found
+        elif raw and found == 'string' and kind != 'json':
+            kind = None  # Values already are text
+
+        formatter = get_formatter(kind, datetime_format=datetime_format,
+                                  binary_format=binary_format)
+        if formatter is None:
+            converters.append(None if engine else stringify_item)
+            continue
+
+        # `str()` in the CSV writer already formats dates and datetimes
+        plain = kind in ('date32', 'timestamp', 'timestamptz') and not datetime_format
+
+        # Cache the text of repeated dates and naive datetimes, when the
+        # first batch is large enough to tell (not with a memory budget)
+        values = [item for item in columns[k] if item is not None] if columns else []
+        cacheable = kind == 'date32' or (kind == 'timestamp' and all(
+            getattr(item, 'tzinfo', None) is None for item in values))
+        if cacheable and len(values) >= FORMAT_CACHE_SAMPLE and len(set(values)) <= len(values) // 2:
+            converters.append(FormatCache(formatter).__getitem__)
+        else:
+            converters.append(None if plain else formatter)
+
+    return converters
+
+
+def convert_rows(rows, converters):
+    """ Apply column converters to a batch of rows """
+
+    plan = [(k, converter)
+            for k, converter in enumerate(converters) if converter]
+    if not plan:
+        return rows
+
+    converted = []
+    for row in rows:
+        row = list(row)
+        for k, converter in plan:
+            row[k] = converter(row[k])
+        converted.append(row)
+
+    return converted
 
 
 def has_stdin_input():
@@ -142,131 +1196,1760 @@ def resolve_home_dir(destination):
     return destination
 
 
-def open_file(destination):
+class BackgroundWriter(io.RawIOBase):
+    """ Binary stream handing writes to a background thread """
+    """ Lets compression and disk writes overlap with fetching rows """
+
+    def __init__(self, file_, max_pending=4, also_close=()):
+        self.file_ = file_
+        self.also_close = also_close
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """ Write pending chunks until the stream is closed """
+
+        while True:
+            chunk = self.pending.get()
+            if chunk is None:
+                break
+
+            if self.error is None:
+                try:
+                    self.file_.write(chunk)
+                except Exception as e:
+                    self.error = e
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.error is not None:
+            raise self.error
+
+        # The caller may reuse its buffer once `write()` returns
+        self.pending.put(bytes(b))
+
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.pending.put(None)
+        self.thread.join()
+        super().close()
+
+        for f in (self.file_,) + tuple(self.also_close):
+            f.close()
+
+        if self.error is not None:
+            raise self.error
+
+
+class DoubleBufferedWriter(io.RawIOBase):
+    """ Binary file written in chunks of `buffer_size` bytes by a background """
+    """ thread, while the other buffer fills up. `fsync` is "close" to sync """
+    """ the file once written or "chunk" to sync each chunk. With """
+    """ `drop_cache`, written pages are dropped from the page cache """
+
+    def __init__(self, raw, buffer_size=FILE_BUFFER_SIZE, fsync=None, drop_cache=False):
+        if buffer_size < 1:
+            raw.close()
+            raise RuntimeError('The write buffer size must be at least 1 byte.')
+
+        self.raw = raw
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.drop_cache = drop_cache and hasattr(os, 'posix_fadvise')
+
+        # Allocated once: fresh buffers would be paged in for each chunk
+        self.buffer, self.spare = bytearray(buffer_size), bytearray(buffer_size)
+        self.size = 0
+        self.offset = self.dropped = raw.tell()
+        self.pending = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """ Write chunks until the file is closed """
+
+        while True:
+            chunk = self.pending.get()
+            try:
+                if chunk is None:
+                    break
+                if self.error is None:
+                    self.write_chunk(chunk)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def write_chunk(self, chunk):
+        """ Write a chunk and apply the fsync and page cache policies """
+
+        view = memoryview(chunk)
+        while view:
+            view = view[self.raw.write(view):]
+
+        if self.fsync == 'chunk':
+            os.fsync(self.raw.fileno())
+
+        self.offset += len(chunk)
+        if self.drop_cache:
+            # Dirty pages are only dropped once written back: each chunk is
+            # advised again after the next one
+            os.posix_fadvise(self.raw.fileno(), self.dropped,
+                             self.offset - self.dropped, os.POSIX_FADV_DONTNEED)
+            self.dropped = self.offset - len(chunk)
+
+    def hand_off(self):
+        """ Queue the filled buffer once the spare one is written """
+
+        self.pending.join()
+        self.pending.put(memoryview(self.buffer)[:self.size])
+        self.buffer, self.spare = self.spare, self.buffer
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.error is not None:
+            raise self.error
+
+        # Every chunk but the last one is `buffer_size` bytes: writes stay aligned
+        view = memoryview(b).cast('B')
+        while view:
+            count = min(len(view), self.buffer_size - self.size)
+            self.buffer[self.size:self.size + count] = view[:count]
+            self.size += count
+            view = view[count:]
+
+            if self.size == self.buffer_size:
+                self.hand_off()
+
+        return len(b)
+
+    def flush(self):
+        if self.size:
+            self.hand_off()
+        self.pending.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self.flush()
+            if self.fsync:
+                os.fsync(self.raw.fileno())
+            if self.drop_cache:
+                os.posix_fadvise(self.raw.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            self.pending.put(None)
+            self.thread.join()
+            self.raw.close()
+            super().close()
+
+
+class ChecksumWriter(io.RawIOBase):
+    """ Binary stream counting and hashing the bytes written to a file """
+
+    def __init__(self, file_):
+        self.file_ = file_
+        self.bytes_written = 0
+        import hashlib
+
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.file_.write(b)
+        self.sha256.update(b)
+        self.bytes_written += len(b)
+
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.file_.close()
+
+
+def get_compression(destination, compress=None):
+    """ Return the requested compression, or infer it from the extension """
+
+    if compress:
+        return compress
+
+    return COMPRESSIONS.get(splitext(destination)[1].lower())
+
+
+def open_compressor(file_, compress, compress_level=None):
+    """ Wrap a binary file in a streaming compressor """
+
+    if compress == 'gzip':
+        import gzip
+
+        return gzip.GzipFile(fileobj=file_, mode='wb',
+                             compresslevel=6 if compress_level is None else compress_level)
+    elif compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                'zstd compression requires the "zstandard" package.')
+
+        return zstandard.ZstdCompressor(
+            level=3 if compress_level is None else compress_level
+        ).stream_writer(file_, closefd=False)
+    elif compress == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise RuntimeError('lz4 compression requires the "lz4" package.')
+
+        return lz4.frame.LZ4FrameFile(
+            file_, mode='wb',
+            compression_level=0 if compress_level is None else compress_level)
+    else:
+        raise RuntimeError(
+            '"%s" compression is not supported.' % (compress))
+
+
+def get_part_name(destination, index):
+    """ Return the name of a numbered part file (`export-00001.csv`) """
+
+    root, ext = splitext(destination)
+
+    # Keep the data extension with the compression one (`.csv.gz`)
+    if ext.lower() in COMPRESSIONS:
+        root, data_ext = splitext(root)
+        ext = data_ext + ext
+
+    return '%s-%05d%s' % (root, index, ext)
+
+
+def get_manifest_name(destination):
+    """ Return the name of the manifest of part files (`export.manifest.json`) """
+
+    root, ext = splitext(destination)
+    if ext.lower() in COMPRESSIONS:
+        root = splitext(root)[0]
+
+    return root + '.manifest.json'
+
+
+def wrap_binary(raw, compress=None, compress_level=None):
+    """ Return a text stream writing to a binary file """
+    """ The output is compressed in a background thread if requested """
+
+    if compress:
+        raw = BackgroundWriter(
+            open_compressor(raw, compress, compress_level=compress_level),
+            also_close=(raw,)
+        )
+
+    # A double-buffered file already receives large writes
+    if not isinstance(raw, DoubleBufferedWriter):
+        raw = io.BufferedWriter(raw, buffer_size=WRITE_BUFFER_SIZE)
+
+    return io.TextIOWrapper(raw, encoding='utf-8', newline='')
+
+
+def open_file(destination, compress=None, compress_level=None, write_buffer_size=FILE_BUFFER_SIZE, fsync=None, drop_cache=False):
     """ Open file """
+    """ Rows are written in `write_buffer_size` chunks by a background thread """
 
     global file_
 
-    file_ = open(destination, 'w+', newline='')
+    raw = DoubleBufferedWriter(open(destination, 'wb', buffering=0),
+                               buffer_size=write_buffer_size, fsync=fsync,
+                               drop_cache=drop_cache)
+    try:
+        file_ = wrap_binary(raw, compress=get_compression(destination, compress),
+                            compress_level=compress_level)
+    except Exception:
+        raw.close()
+        raise
 
     return file_
 
 
-def open_tempfile():
-    """ Open a temporary file """
+def open_part(destination, compress=None, compress_level=None, write_buffer_size=FILE_BUFFER_SIZE, fsync=None, drop_cache=False):
+    """ Open a part file, return it with a `ChecksumWriter` of its bytes """
 
     global file_
 
-    file_ = tempfile.NamedTemporaryFile('w+', newline='', delete=False)
+    checksum = ChecksumWriter(DoubleBufferedWriter(
+        open(destination, 'wb', buffering=0), buffer_size=write_buffer_size,
+        fsync=fsync, drop_cache=drop_cache))
+    file_ = wrap_binary(checksum,
+                        compress=get_compression(destination, compress),
+                        compress_level=compress_level)
 
-    return file_
+    return file_, checksum
+
+
+@contextmanager
+def open_stdout():
+    """ Open a buffered text stream writing straight to stdout """
+
+    global file_
+
+    sys.stdout.flush()
 
+    # Text-only streams (e.g. a `StringIO`) are written to directly
+    if not hasattr(sys.stdout, 'buffer'):
+        file_ = sys.stdout
+        yield file_
+        return
 
-def get_writer(file_, delimiter=',', quotechar='"'):
+    file_ = io.TextIOWrapper(
+        sys.stdout.buffer, encoding=sys.stdout.encoding, newline='')
+    try:
+        yield file_
+    finally:
+        # Flush pending rows and hand the buffer back to `sys.stdout`
+        file_.flush()
+        file_.detach()
+
+
+def get_writer(file_, delimiter=',', quotechar='"', lineterminator='\r\n'):
     """ Return a writer object """
 
     return csv.writer(
         file_,
         delimiter=delimiter,
         quotechar=quotechar,
-        quoting=csv.QUOTE_MINIMAL
+        quoting=csv.QUOTE_MINIMAL,
+        lineterminator=lineterminator
     )
 
 
-def file_to_stdout():
-    """ Print file content to stdout """
-
-    with open(file_.name) as f:
-        print(f.read())
+def stdin_to_csv(delimiter=',', quotechar='"', input_format=None):
+    """ Parse stdin and return output in a CSV format """
+    """ The input format is sniffed from the first lines unless set """
 
+    # Read raw bytes when available, decoding is done once per block
+    blocks = read_lines(getattr(sys.stdin, 'buffer', sys.stdin))
 
-def stdin_to_csv(delimiter=',', quotechar='"'):
-    """ Parse stdin and return output in a CSV format """
+    # Pick a parser from the first block of lines
+    first = next(blocks, [])
+    if input_format is None:
+        input_format = sniff_format(first)
+    parser = STDIN_PARSERS[input_format]
 
     # Open CSV
-    with open_tempfile() as file_:
-        writer = get_writer(file_, delimiter=delimiter, quotechar=quotechar)
+    with open_stdout() as file_:
+        writer = get_writer(file_, delimiter=delimiter,
+                            quotechar=quotechar, lineterminator='\n')
 
-        # Parse lines and add to file
-        separator = None
-        for line in sys.stdin:
-            # Strip whitespaces
-            line.strip()
+        # Parse blocks of lines and add to file
+        for rows in parser(chain([first], blocks)):
+            writer.writerows(rows)
 
-            if not discard_line(line):
-                # Get column separator
-                separator = get_column_separator(
-                    line) if not separator else separator
 
-                # Remove leading and trailing |
-                line = remove_leading_trailing_pipe(line)
+def get_peak_rss():
+    """ Return the peak resident set size of the process in bytes """
+    """ `None` where the `resource` module is not available """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Reported in kilobytes on Linux, in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
 
-                if line.strip():
-                    # Split columns with separator
-                    row = split_columns(line, separator)
 
-                    # Add to CSV
-                    row = strip_whitespaces(row)
+class ExportMetrics:
+    """ Time spent per stage, row and byte counts of an export """
+    """ A JSON line is written to stderr every `interval` seconds when set """
 
-                    # Write row
-                    writer.writerow(row)
+    STAGES = ('execute', 'fetch', 'encode', 'write')
 
-    file_to_stdout()
+    def __init__(self, interval=None, stream=None):
+        self.interval = interval
+        self.stream = stream
+        self.started = self.last_emit = time.perf_counter()
+        self.time_to_first_row = None
+        self.times = dict.fromkeys(self.STAGES, 0.0)
+        self.rows = 0
+        self.bytes = 0
 
+    @contextmanager
+    def timer(self, stage):
+        """ Add the time spent in the block to `stage` """
 
-def query_to_csv(engine, host, user, port, password, database, query, headers=False, out_type='stdout', destination_file=None, delimiter=',', quotechar='"', print_info=1000):
-    """ Run a query and store the result to a CSV file """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[stage] += time.perf_counter() - start
 
-    # Get SQL connection
-    connection = get_connection(
+    def add_rows(self, count):
+        """ Count fetched rows and emit a progress line when due """
+
+        now = time.perf_counter()
+        if count and self.time_to_first_row is None:
+            self.time_to_first_row = now - self.started
+        self.rows += count
+
+        if self.interval and now - self.last_emit >= self.interval:
+            self.emit('progress')
+            self.last_emit = now
+
+    def add_bytes(self, text):
+        """ Count the bytes of encoded text """
+
+        self.bytes += len(text) if text.isascii() else len(text.encode('utf-8'))
+
+    def summary(self):
+        """ Return the metrics as a dict """
+
+        elapsed = time.perf_counter() - self.started
+        summary = {'rows': self.rows, 'bytes': self.bytes,
+                   'elapsed': round(elapsed, 6),
+                   'time_to_first_row': self.time_to_first_row and round(self.time_to_first_row, 6)}
+        for stage in self.STAGES:
+            summary[stage + '_time'] = round(self.times[stage], 6)
+        summary['rows_per_sec'] = round(self.rows / elapsed, 1) if elapsed else None
+        summary['bytes_per_sec'] = round(self.bytes / elapsed, 1) if elapsed else None
+        summary['peak_rss_bytes'] = get_peak_rss()
+
+        return summary
+
+    def emit(self, event):
+        """ Write the metrics as a JSON line """
+
+        print(json.dumps(dict(event=event, **self.summary())),
+              file=self.stream or sys.stderr, flush=True)
+
+    def write_summary(self, path):
+        """ Write the metrics to a JSON file """
+
+        with open(resolve_home_dir(path), 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write('\n')
+
+    def write_prometheus(self, path):
+        """ Write the metrics in the Prometheus text format """
+        """ The file is replaced atomically for the node_exporter textfile collector """
+
+        summary = self.summary()
+        metrics = [
+            ('rows', 'Rows exported', 'gauge', [('', summary['rows'])]),
+            ('bytes', 'Bytes of CSV encoded', 'gauge', [('', summary['bytes'])]),
+            ('duration_seconds', 'Duration of the export', 'gauge', [('', summary['elapsed'])]),
+            ('time_to_first_row_seconds', 'Time until the first row was fetched', 'gauge',
+             [('', summary['time_to_first_row'])]),
+            ('stage_seconds', 'Time spent per export stage', 'gauge',
+             [('{stage="%s"}' % stage, summary[stage + '_time']) for stage in self.STAGES]),
+            ('peak_rss_bytes', 'Peak resident set size', 'gauge', [('', summary['peak_rss_bytes'])]),
+        ]
+
+        lines = []
+        for name, help_, type_, samples in metrics:
+            lines.append('# HELP sql2csv_%s %s' % (name, help_))
+            lines.append('# TYPE sql2csv_%s %s' % (name, type_))
+            lines.extend('sql2csv_%s%s %s' % (name, labels, value)
+                         for labels, value in samples if value is not None)
+
+        path = resolve_home_dir(path)
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+def timed(metrics, stage):
+    """ Time a block as `stage` of `metrics`, a no-op without metrics """
+
+    return metrics.timer(stage) if metrics else nullcontext()
+
+
+class CountingFile(io.TextIOBase):
+    """ Text file wrapper adding the bytes written to `metrics` """
+    """ For exports written by the database driver, such as a PostgreSQL COPY """
+    """ (psycopg2 only writes `str` to an `io.TextIOBase`) """
+
+    def __init__(self, file_, metrics):
+        self.file_ = file_
+        self.metrics = metrics
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.metrics.add_bytes(text)
+        return self.file_.write(text)
+
+    def flush(self):
+        self.file_.flush()
+
+
+def encode_rows(rows, delimiter=',', quotechar='"', lineterminator='\r\n', converters=None):
+    """ Encode a batch of rows to a CSV string """
+    """ Every column is checked for dicts when `converters` is not set """
+
+    if converters is None:
+        converters = [stringify_item] * len(rows[0]) if rows else []
+
+    buffer_ = io.StringIO()
+    writer = get_writer(buffer_, delimiter=delimiter, quotechar=quotechar,
+                        lineterminator=lineterminator)
+    writer.writerows(convert_rows(rows, converters))
+
+    return buffer_.getvalue()
+
+
+def print_progress(count, batch_size, print_info, sizer=None):
+    """ Print the row count when a batch crosses a `print_info` multiple """
+    """ With a `sizer`, the current fetch size is reported as well """
+
+    if print_info and count // print_info > (count - batch_size) // print_info:
+        if sizer:
+            print('  ...%s rows written (fetching %s rows of ~%s bytes)' % (
+                "{:,}".format(count), "{:,}".format(sizer.size),
+                "{:,}".format(int(sizer.row_bytes))))
+        else:
+            print('  ...%s rows written' % "{:,}".format(count))
+
+
+def write_encoded_batches(pending, file_, errors, print_info=None, metrics=None, sizer=None):
+    """ Writer stage: write encoded batches in the order they were fetched """
+    """ Time spent waiting for the encoding processes counts as encode time """
+
+    count = 0
+    while True:
+        item = pending.get()
+        if item is None:
+            break
+
+        batch_size, future = item
+        if errors:
+            # Keep draining so the fetch stage never blocks on a full queue
+            future.cancel()
+            continue
+
+        try:
+            if metrics:
+                with metrics.timer('encode'):
+                    text = future.result()
+                with metrics.timer('write'):
+                    file_.write(text)
+                metrics.add_bytes(text)
+            else:
+                text = future.result()
+                file_.write(text)
+        except Exception as e:
+            errors.append(e)
+            continue
+
+        if sizer:
+            sizer.observe(batch_size, len(text))
+
+        count += batch_size
+        print_progress(count, batch_size, print_info, sizer=sizer)
+
+
+def write_batches_pipelined(batches, file_, workers, delimiter=',', quotechar='"', lineterminator='\r\n', print_info=None, converters=None, metrics=None, sizer=None):
+    """ Fetch batches while a pool of processes encodes the previous ones """
+    """ Return the number of rows written """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Bounded queue: fetching pauses when the writer falls behind
+    pending = queue.Queue(maxsize=workers * 2)
+    errors = []
+    writer = threading.Thread(target=write_encoded_batches,
+                              args=(pending, file_, errors, print_info, metrics, sizer))
+
+    count = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        writer.start()
+        try:
+            for rows in batches:
+                if errors:
+                    break
+
+                pending.put((len(rows), executor.submit(
+                    encode_rows, rows, delimiter, quotechar, lineterminator,
+                    converters)))
+                count += len(rows)
+        finally:
+            pending.put(None)
+            writer.join()
+
+    if errors:
+        raise errors[0]
+
+    return count
+
+
+def write_rows(cursor, file_, headers=False, delimiter=',', quotechar='"', lineterminator='\r\n', fetch_size=FETCH_SIZE, print_info=None, workers=1, engine=None, on_batch=None, metrics=None, datetime_format=None, binary_format='hex', raw=False, memory_budget=None):
+    """ Fetch the rows of an executed query and write them as CSV """
+    """ `on_batch` is called with each fetched batch once written (serial path) """
+    """ With `memory_budget`, `fetch_size` is replaced by batch sizes adapted """
+    """ to the width of the rows. Return the number of rows written """
+
+    writer = get_writer(file_, delimiter=delimiter, quotechar=quotechar,
+                        lineterminator=lineterminator)
+
+    # The budget is shared by the batches queued for the encoding processes
+    sizer = None
+    if memory_budget:
+        sizer = FetchSizer(memory_budget // (workers * 2 + 1)
+                           if workers > 1 else memory_budget)
+
+    # Server-side cursors only expose a description after a first fetch
+    batches = fetch_batches(cursor=cursor, fetch_size=fetch_size,
+                            metrics=metrics, sizer=sizer)
+    first_batch = next(batches, [])
+
+    # Write headers if requested
+    if headers:
+        writer.writerow(fetch_headers(cursor=cursor))
+
+    converters = get_converters(cursor, engine=engine, rows=first_batch,
+                                datetime_format=datetime_format,
+                                binary_format=binary_format, raw=raw)
+
+    # Encode rows in worker processes
+    if workers > 1:
+        return write_batches_pipelined(
+            chain([first_batch], batches),
+            file_,
+            workers,
+            delimiter=delimiter,
+            quotechar=quotechar,
+            lineterminator=lineterminator,
+            print_info=print_info,
+            converters=converters,
+            metrics=metrics,
+            sizer=sizer
+        )
+
+    # Write rows to CSV
+    i = 0
+    for batch in chain([first_batch], batches):
+        # Encode batches to a string first to time encoding and writing
+        # apart, or to measure the encoded rows
+        if metrics or sizer:
+            with timed(metrics, 'encode'):
+                text = encode_rows(batch, delimiter, quotechar,
+                                   lineterminator, converters)
+            with timed(metrics, 'write'):
+                file_.write(text)
+            if metrics:
+                metrics.add_bytes(text)
+            if sizer:
+                sizer.observe(len(batch), len(text))
+        else:
+            writer.writerows(convert_rows(batch, converters))
+
+        # Keys are read from the fetched values, not the formatted ones
+        if on_batch:
+            on_batch(batch)
+
+        # Increment row counter
+        i += len(batch)
+        print_progress(i, len(batch), print_info, sizer=sizer)
+
+    return i
+
+
+def get_checkpoint_name(destination):
+    """ Return the name of the checkpoint file of an export """
+
+    return destination + '.checkpoint.json'
+
+
+def read_checkpoint(destination):
+    """ Return the checkpoint recorded for an export, `None` if there is none """
+
+    try:
+        with open(get_checkpoint_name(destination)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(destination, state):
+    """ Atomically record the checkpoint of an export """
+
+    name = get_checkpoint_name(destination)
+    with open(name + '.tmp', 'w') as f:
+        json.dump(state, f, default=str)
+    os.replace(name + '.tmp', name)
+
+
+def get_column_index(cursor, column):
+    """ Return the position of a column in the query result """
+
+    names = [name.lower() for name in fetch_headers(cursor=cursor)]
+    if column.lower() not in names:
+        raise RuntimeError(
+            'The column "%s" is not part of the query result.' % (column))
+
+    return names.index(column.lower())
+
+
+def get_watermark_name(destination):
+    """ Return the name of the default state file of an incremental export """
+
+    return destination + '.watermark.json'
+
+
+def get_watermark_key(engine, host, database, query, column):
+    """ Return the key of an incremental export in its state file """
+
+    return '%s://%s/%s %s: %s' % (engine, host, database, column, query.strip().rstrip(';'))
+
+
+def read_watermark(state_file, key):
+    """ Return the high-water mark recorded for an incremental export """
+    """ `None` if it never completed """
+
+    try:
+        with open(state_file) as f:
+            return json.load(f).get(key, {}).get('watermark')
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(state_file, key, watermark, rows):
+    """ Atomically record the high-water mark of an incremental export """
+    """ A state file can be shared by the jobs of a job file """
+
+    with WATERMARK_LOCK:
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+
+        state[key] = {
+            'watermark': watermark,
+            'rows': rows,
+            'exported_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2, default=str)
+        os.replace(state_file + '.tmp', state_file)
+
+
+def export_delta(cursor, file_, query, watermark_column, watermark=None, headers=False, delimiter=',', quotechar='"', lineterminator='\r\n', fetch_size=FETCH_SIZE, print_info=None, engine=None, metrics=None, datetime_format=None, binary_format='hex', memory_budget=None):
+    """ Export the rows of a query with `watermark_column` above `watermark` """
+    """ Return the new high-water mark and the number of rows written """
+
+    conditions, params = [], ()
+    if watermark is not None:
+        conditions = ['%s > %%s' % (watermark_column)]
+        params = (watermark,)
+        if print_info:
+            print('  ...exporting rows after %s %s' % (watermark_column, watermark))
+
+    with timed(metrics, 'execute'):
+        execute_query(cursor=cursor, query=wrap_query(query, conditions),
+                      params=params)
+
+    progress = {'index': None, 'watermark': None}
+
+    def track(rows):
+        """ Keep the highest value of the watermark column """
+
+        if progress['index'] is None:
+            progress['index'] = get_column_index(cursor, watermark_column)
+
+        values = [row[progress['index']] for row in rows
+                  if row[progress['index']] is not None]
+        if values:
+            progress['watermark'] = max(values if progress['watermark'] is None
+                                        else values + [progress['watermark']])
+
+    count = write_rows(
+        cursor,
+        file_,
+        headers=headers,
+        delimiter=delimiter,
+        quotechar=quotechar,
+        lineterminator=lineterminator,
+        fetch_size=fetch_size,
+        print_info=print_info,
         engine=engine,
-        host=host,
-        user=user,
-        port=port,
-        password=password,
-        database=database
+        on_batch=track,
+        metrics=metrics,
+        datetime_format=datetime_format,
+        binary_format=binary_format,
+        memory_budget=memory_budget
     )
-    cursor = get_cursor(connection)
 
-    if out_type == 'file':
-        print('\n* Exporting rows...')
+    return progress['watermark'], count
+
+
+def write_resumable(cursor, query, destination, checkpoint_column, headers=False, delimiter=',', quotechar='"', fetch_size=FETCH_SIZE, print_info=None, engine=None, checkpoint_rows=CHECKPOINT_ROWS, metrics=None, datetime_format=None, binary_format='hex', raw=False, memory_budget=None, write_buffer_size=FILE_BUFFER_SIZE, fsync=None, drop_cache=False):
+    """ Export rows ordered by `checkpoint_column` to a resumable file """
+    """ Every `checkpoint_rows` rows, the last key and the file offset are """
+    """ recorded; a new run truncates the file to the last offset and only """
+    """ fetches rows after the last key. Return the number of rows written """
+
+    state = read_checkpoint(destination)
+    if state and (state['query'] != query or state['column'] != checkpoint_column):
+        raise RuntimeError(
+            'The checkpoint of %s was recorded for another query.' % (destination))
+
+    conditions, params = [], ()
+    if state:
+        conditions = ['%s > %%s' % (checkpoint_column)]
+        params = (state['last_key'],)
+        print('  ...resuming after %s %s (%s rows)' % (
+            checkpoint_column, state['last_key'], "{:,}".format(state['rows'])))
+
+        # Discard anything written after the last checkpoint
+        output = open(destination, 'r+b', buffering=0)
+        output.truncate(state['offset'])
+        output.seek(state['offset'])
+    else:
+        state = {'query': query, 'column': checkpoint_column,
+                 'last_key': None, 'offset': 0, 'rows': 0}
+        output = open(destination, 'wb', buffering=0)
+
+    # Rows must come in key order for the keyset predicate to be correct
+    with timed(metrics, 'execute'):
+        execute_query(cursor=cursor, query='%s ORDER BY %s' % (
+            wrap_query(query, conditions), checkpoint_column), params=params)
+
+    file_ = wrap_binary(DoubleBufferedWriter(
+        output, buffer_size=write_buffer_size, fsync=fsync, drop_cache=drop_cache))
+    progress = {'index': None, 'rows': 0}
+
+    def checkpoint(rows):
+        """ Record the last key once `checkpoint_rows` rows were written """
+
+        if not rows:
+            return
+
+        if progress['index'] is None:
+            progress['index'] = get_column_index(cursor, checkpoint_column)
+
+        state['rows'] += len(rows)
+        state['last_key'] = rows[-1][progress['index']]
+        progress['rows'] += len(rows)
+
+        if progress['rows'] >= checkpoint_rows:
+            # Make the rows durable before recording their offset
+            file_.flush()
+            os.fsync(output.fileno())
+            state['offset'] = output.tell()
+            write_checkpoint(destination, state)
+            progress['rows'] = 0
+
+    with file_:
+        count = write_rows(
+            cursor,
+            file_,
+            headers=headers and not state['rows'],
+            delimiter=delimiter,
+            quotechar=quotechar,
+            fetch_size=fetch_size,
+            print_info=print_info,
+            engine=engine,
+            on_batch=checkpoint,
+            metrics=metrics,
+            datetime_format=datetime_format,
+            binary_format=binary_format,
+            raw=raw,
+            memory_budget=memory_budget
+        )
+
+    # The export is complete
+    if os.path.exists(get_checkpoint_name(destination)):
+        os.remove(get_checkpoint_name(destination))
+
+    return count
+
+
+def write_parts(cursor, destination, headers=False, delimiter=',', quotechar='"', fetch_size=FETCH_SIZE, print_info=None, engine=None, compress=None, compress_level=None, max_rows=None, max_bytes=None, metrics=None, datetime_format=None, binary_format='hex', raw=False, write_buffer_size=FILE_BUFFER_SIZE, fsync=None, drop_cache=False):
+    """ Fetch the rows of an executed query and split them into part files """
+    """ A part is closed once it holds `max_rows` rows or `max_bytes` bytes """
+    """ (checked after each batch), return the list of parts written """
+
+    # Server-side cursors only expose a description after a first fetch
+    batches = fetch_batches(cursor=cursor, fetch_size=fetch_size,
+                            metrics=metrics)
+    first_batch = next(batches, [])
+
+    header = fetch_headers(cursor=cursor) if headers else None
+    converters = get_converters(cursor, engine=engine, rows=first_batch,
+                                datetime_format=datetime_format,
+                                binary_format=binary_format, raw=raw)
+
+    parts = []
+    part_file = checksum = writer = None
+
+    # Encode batches to a string first to time encoding and writing apart
+    if metrics:
+        buffer_ = io.StringIO()
+        buffer_writer = get_writer(buffer_, delimiter=delimiter, quotechar=quotechar)
+
+    def open_next_part():
+        name = get_part_name(destination, len(parts) + 1)
+        part_file, checksum = open_part(name, compress=compress,
+                                        compress_level=compress_level,
+                                        write_buffer_size=write_buffer_size,
+                                        fsync=fsync, drop_cache=drop_cache)
+        writer = get_writer(part_file, delimiter=delimiter, quotechar=quotechar)
+        if header:
+            writer.writerow(header)
+        parts.append({'file': basename(name), 'rows': 0})
+
+        return part_file, checksum, writer
+
+    def close_part():
+        part_file.close()
+        parts[-1]['bytes'] = checksum.bytes_written
+        parts[-1]['sha256'] = checksum.sha256.hexdigest()
+
+    i = 0
+    for rows in chain([first_batch], batches):
+        with timed(metrics, 'encode'):
+            rows = convert_rows(rows, converters)
+        while rows:
+            if part_file is None:
+                part_file, checksum, writer = open_next_part()
+
+            # Fill the current part up to `max_rows`
+            size = len(rows)
+            if max_rows:
+                size = min(size, max_rows - parts[-1]['rows'])
+            if metrics:
+                with metrics.timer('encode'):
+                    buffer_.seek(0)
+                    buffer_.truncate()
+                    buffer_writer.writerows(rows[:size])
+                    text = buffer_.getvalue()
+                with metrics.timer('write'):
+                    part_file.write(text)
+                metrics.add_bytes(text)
+            else:
+                writer.writerows(rows[:size])
+            rows = rows[size:]
+            parts[-1]['rows'] += size
+
+            # Increment row counter
+            i += size
+            print_progress(i, size, print_info)
+
+            if max_bytes:
+                part_file.flush()
+
+            if (max_rows and parts[-1]['rows'] >= max_rows) or (max_bytes and checksum.bytes_written >= max_bytes):
+                close_part()
+                part_file = None
+
+    # An empty result still produces a part (with headers if requested)
+    if not parts:
+        part_file, checksum, writer = open_next_part()
+    if part_file is not None:
+        close_part()
+
+    return parts
+
+
+def write_manifest(destination, parts):
+    """ Write the list of parts as a JSON manifest, return its name """
+
+    name = get_manifest_name(destination)
+    with open(name, 'w') as f:
+        json.dump({
+            'rows': sum(part['rows'] for part in parts),
+            'parts': parts
+        }, f, indent=2)
+
+    return name
+
+
+def import_pyarrow():
+    """ Import pyarrow, only needed by the columnar formats """
+
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError(
+            'Parquet and Arrow formats require the "pyarrow" package.')
+
+    return pyarrow
+
+
+def get_arrow_type(pa, name, column):
+    """ Return the Arrow type matching an `ARROW_TYPES` name """
+
+    if name == 'decimal':
+        precision, scale = column[4], column[5]
+        if precision and scale is not None and precision <= 38:
+            return pa.decimal128(precision, scale)
+
+        # Unconstrained numbers are exported as text
+        return pa.string()
+    elif name == 'timestamp':
+        return pa.timestamp('us')
+    elif name == 'timestamptz':
+        return pa.timestamp('us', tz='UTC')
+    elif name == 'time64':
+        return pa.time64('us')
+    elif name == 'duration':
+        return pa.duration('us')
+
+    return getattr(pa, name)()
+
+
+def get_arrow_schema(pa, cursor, rows, engine=None):
+    """ Map `cursor.description` type codes to an Arrow schema """
+    """ Unknown types are inferred from a first batch of `rows` """
+
+    types = ENGINES[engine].arrow_types if engine in ENGINES else {}
+
+    fields = []
+    for k, column in enumerate(cursor.description):
+        if column[1] in types:
+            type_ = get_arrow_type(pa, types[column[1]], column)
+        else:
+            try:
+                type_ = pa.array([row[k] for row in rows]).type
+            except (pa.ArrowException, TypeError, ValueError):
+                type_ = pa.string()
+
+            if pa.types.is_null(type_):
+                type_ = pa.string()
+
+        fields.append(pa.field(column[0], type_))
+
+    return pa.schema(fields)
+
+
+def to_text(item):
+    """ Return an item as text for string columns """
+    """ Bytes must be UTF-8, `UnicodeDecodeError` is raised otherwise """
+
+    if item is None or isinstance(item, str):
+        return item
+    elif isinstance(item, (dict, list)):
+        return json.dumps(item)
+    elif isinstance(item, (bytes, bytearray, memoryview)):
+        return bytes(item).decode('utf-8')
+
+    return str(item)
+
+
+def rows_to_record_batch(pa, rows, schema):
+    """ Transpose a batch of rows into an Arrow record batch """
+
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+
+    arrays = []
+    for values, field in zip(columns, schema):
+        if pa.types.is_string(field.type):
+            try:
+                values = [to_text(item) for item in values]
+            except UnicodeDecodeError:
+                # Binary values are never written lossily as text
+                raise RuntimeError(
+                    'Column "%s" is written as text but holds binary values. Its type '
+                    'is guessed from the first rows, try a larger --row-group-size.' % (field.name))
+        elif pa.types.is_binary(field.type):
+            values = [None if item is None else bytes(item)
+                      for item in values]
+
+        arrays.append(pa.array(values, type=field.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
 
-    with open_tempfile() if out_type == 'stdout' else open_file(resolve_home_dir(destination_file)) as file_:
-        writer = get_writer(file_, delimiter=delimiter, quotechar=quotechar)
 
-        # Execute query
-        execute_query(cursor=cursor, query=query)
+def open_columnar_writer(pa, destination, schema, format_='parquet', compress=None, compress_level=None):
+    """ Open a Parquet or Arrow IPC file writer """
 
-        # Write headers if requested
-        if headers:
-            writer.writerow(fetch_headers(cursor=cursor))
+    if format_ == 'parquet':
+        return pa.parquet.ParquetWriter(
+            destination, schema,
+            compression=compress or 'snappy',
+            compression_level=compress_level
+        )
+    elif format_ == 'arrow':
+        if compress not in (None, 'zstd', 'lz4'):
+            raise RuntimeError(
+                '"%s" compression is not supported by Arrow files.' % (compress))
+
+        return pa.ipc.new_file(
+            destination, schema,
+            options=pa.ipc.IpcWriteOptions(compression=compress)
+        )
+    else:
+        raise RuntimeError(
+            '"%s" format is not supported.' % (format_))
+
+
+def write_columnar(cursor, destination, format_='parquet', engine=None, row_group_size=ROW_GROUP_SIZE, compress=None, compress_level=None, print_info=None, metrics=None):
+    """ Fetch the rows of an executed query and write them as Parquet or Arrow """
+    """ Each fetched batch of `row_group_size` rows becomes a record batch """
+    """ Return the number of rows written """
+
+    pa = import_pyarrow()
+
+    # Server-side cursors only expose a description after a first fetch
+    batches = fetch_batches(cursor=cursor, fetch_size=row_group_size,
+                            metrics=metrics)
+    first_batch = next(batches, [])
+
+    schema = get_arrow_schema(pa, cursor, first_batch, engine=engine)
+    writer = open_columnar_writer(pa, destination, schema, format_=format_,
+                                  compress=compress, compress_level=compress_level)
+
+    i = 0
+    try:
+        for rows in chain([first_batch], batches):
+            if rows:
+                with timed(metrics, 'encode'):
+                    batch = rows_to_record_batch(pa, rows, schema)
+                with timed(metrics, 'write'):
+                    writer.write_batch(batch)
 
-        # Write rows to CSV
-        i = 0
-        for row in fetch_rows(cursor=cursor):
             # Increment row counter
-            i += 1
+            i += len(rows)
+            print_progress(i, len(rows), print_info)
+    finally:
+        writer.close()
+
+    # Encoded size is the size of the file
+    if metrics:
+        metrics.bytes = os.path.getsize(destination)
+
+    return i
+
+
+def export_chunk(connection, engine, query, conditions, params, destination, raw=False, headers=False, delimiter=',', quotechar='"', lineterminator='\r\n', fetch_size=FETCH_SIZE, workers=1, compress=None, compress_level=None, datetime_format=None, binary_format='hex', memory_budget=None, write_buffer_size=FILE_BUFFER_SIZE, fsync=None, drop_cache=False):
+    """ Export one chunk of a parallel export to its own file """
+    """ `connection` is already in the snapshot of the export, and left open """
+
+    cursor = get_cursor(connection, engine=engine)
+    try:
+        with open_file(destination, compress=compress, compress_level=compress_level, write_buffer_size=write_buffer_size, fsync=fsync, drop_cache=drop_cache) as file_:
+            execute_query(cursor=cursor, query=wrap_query(
+                query, conditions), params=params)
+            return write_rows(cursor, file_, headers=headers,
+                              delimiter=delimiter, quotechar=quotechar,
+                              lineterminator=lineterminator, fetch_size=fetch_size,
+                              workers=workers, engine=engine,
+                              datetime_format=datetime_format,
+                              binary_format=binary_format, raw=raw,
+                              memory_budget=memory_budget)
+    finally:
+        cursor.close()
+
+
+def parallel_query_to_csv(engine, host, user, port, password, database, query, split_column, parallel, headers=False, out_type='stdout', destination_file=None, delimiter=',', quotechar='"', fetch_size=FETCH_SIZE, part_files=False, workers=1, compress=None, compress_level=None, datetime_format=None, binary_format='hex', raw=False, memory_budget=None, write_buffer_size=FILE_BUFFER_SIZE, fsync=None, drop_cache=False):
+    """ Run a query as `parallel` key range chunks on separate connections """
+    """ Chunks are merged in order, or kept as part files with `part_files` """
+
+    import shutil
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    if part_files and out_type != 'file':
+        raise RuntimeError('Part files require a destination file.')
+
+    connection_args = {
+        'engine': engine,
+        'host': host,
+        'user': user,
+        'port': port,
+        'password': password,
+        'database': database,
+        'raw': raw
+    }
+
+    # Split bounds are computed, so they need decoded values
+    connection = get_connection(**dict(connection_args, raw=False))
+    connections = []
+    try:
+        for _ in range(parallel):
+            connections.append(get_connection(**connection_args))
+
+        # Chunks and split bounds all read the same data
+        start_shared_snapshot(connection, connections, engine)
+
+        cursor = connection.cursor()
+        low, high = get_split_bounds(cursor, query, split_column)
+        cursor.close()
+
+        boundaries = split_range(low, high, parallel) if low is not None else []
+        filters = get_chunk_filters(split_column, boundaries)
+
+        if out_type == 'file':
+            destination_file = resolve_home_dir(destination_file)
+            print('\n* Exporting rows in %d chunks...' % (len(filters)))
+
+        # Each chunk is written to a part file, merged afterwards if requested
+        if part_files:
+            destinations = [get_part_name(destination_file, i + 1)
+                            for i in range(len(filters))]
+        else:
+            directory = dirname(destination_file) if out_type == 'file' else None
+            destinations = []
+            for _ in filters:
+                fd, name = tempfile.mkstemp(suffix='.part', dir=directory or None)
+                os.close(fd)
+                destinations.append(name)
+
+        try:
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                futures = [
+                    executor.submit(
+                        export_chunk,
+                        connections[i], engine, query, conditions, params, destinations[i],
+                        raw=raw,
+                        headers=headers and (part_files or i == 0),
+                        delimiter=delimiter,
+                        quotechar=quotechar,
+                        lineterminator='\n' if out_type == 'stdout' else '\r\n',
+                        fetch_size=fetch_size,
+                        workers=workers,
+                        compress=compress if part_files else None,
+                        compress_level=compress_level,
+                        datetime_format=datetime_format,
+                        binary_format=binary_format,
+                        memory_budget=memory_budget // parallel if memory_budget else None,
+                        write_buffer_size=write_buffer_size,
+                        fsync=fsync if part_files else None,
+                        drop_cache=drop_cache and part_files
+                    )
+                    for i, (conditions, params) in enumerate(filters)
+                ]
+                for i, future in enumerate(futures):
+                    count = future.result()
+                    if out_type == 'file':
+                        print('  ...chunk %d/%d done (%s rows)' %
+                              (i + 1, len(futures), "{:,}".format(count)))
+
+            if not part_files:
+                with open_stdout() if out_type == 'stdout' else open_file(destination_file, compress=compress, compress_level=compress_level, write_buffer_size=write_buffer_size, fsync=fsync, drop_cache=drop_cache) as file_:
+                    for name in destinations:
+                        with open(name, encoding='utf-8', newline='') as part:
+                            shutil.copyfileobj(part, file_)
+        finally:
+            if not part_files:
+                for name in destinations:
+                    os.remove(name)
+    finally:
+        # Also ends the snapshot transactions when a chunk fails
+        for chunk_connection in connections:
+            chunk_connection.close()
+        connection.close()
+
+    if out_type == 'file':
+        print('  ...done')
+        print('* The result has been exported to %s.\n' %
+              (destination_file if not part_files else ', '.join(destinations)))
+
+
+def get_cache_key(arguments, freshness=None):
+    """ Return the cache key of a `query_to_csv()` call """
+    """ `freshness` is the result of the freshness query, if any """
+
+    key = {name: arguments.get(name) for name in CACHE_KEY_ARGS}
+    key['compress'] = get_compression(arguments['destination_file'], arguments.get('compress'))
+    key['compress_level'] = arguments.get('compress_level')
+    key['freshness'] = freshness
+
+    import hashlib
+
+    return hashlib.sha256(json.dumps(
+        key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def read_cache(cache_dir, key, destination, ttl=CACHE_TTL):
+    """ Copy a cached result younger than `ttl` seconds to `destination` """
+    """ Return `True` on a hit. The access time of entries orders evictions """
+
+    import shutil
+
+    entry = os.path.join(cache_dir, key + '.cache')
+    try:
+        created_at = os.path.getmtime(entry)
+        if time.time() - created_at > ttl:
+            return False
+
+        shutil.copyfile(entry, destination)
+        os.utime(entry, (time.time(), created_at))
+    except FileNotFoundError:  # Missing, or evicted by another process
+        return False
+
+    return True
+
+
+def write_cache(cache_dir, key, source, max_size=CACHE_SIZE):
+    """ Store an exported file in the cache, then evict the least recently """
+    """ used entries until the cache holds at most `max_size` bytes """
+
+    import shutil
+    import tempfile
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Readers never see a partially copied entry
+    fd, name = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    os.close(fd)
+    shutil.copyfile(source, name)
+    os.replace(name, os.path.join(cache_dir, key + '.cache'))
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.cache'):
+            stat = entry.stat()
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, path in sorted(entries):
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        size -= entry_size
+
+
+def get_freshness(arguments, freshness_query):
+    """ Run the freshness query (e.g. `SELECT max(updated_at) FROM t`) """
+    """ and return its first row """
+
+    with borrow_connection(
+        connection=arguments['connection'],
+        pool=arguments['pool'],
+        engine=arguments['engine'],
+        host=arguments['host'],
+        user=arguments['user'],
+        port=arguments['port'],
+        password=arguments['password'],
+        database=arguments['database']
+    ) as connection:
+        cursor = connection.cursor()
+        execute_query(cursor=cursor, query=freshness_query)
+        row = cursor.fetchone()
+        cursor.close()
+
+    return list(row) if row else None
+
+
+def cached_query_to_csv(arguments, cache_dir, ttl=CACHE_TTL, max_size=CACHE_SIZE, freshness_query=None):
+    """ Serve a `query_to_csv()` call from the result cache without querying """
+    """ the database, or run it and cache its result. With `freshness_query`, """
+    """ only that query runs on a hit and its result is part of the key """
+
+    if arguments['out_type'] != 'file':
+        raise RuntimeError('The result cache requires a destination file.')
+    if arguments['part_files'] or arguments['max_rows_per_file'] or arguments['max_bytes_per_file'] or arguments['resume']:
+        raise RuntimeError(
+            'The result cache cannot be combined with part files, split files or a resumable export.')
+
+    cache_dir = resolve_home_dir(cache_dir)
+    destination_file = resolve_home_dir(arguments['destination_file'])
 
-            if out_type == 'file' and i % print_info == 0:
-                print('  ...%s rows written' % "{:,}".format(i))
+    freshness = get_freshness(arguments, freshness_query) if freshness_query else None
+    key = get_cache_key(arguments, freshness=freshness)
 
-            row = stringify_items(row)
+    if read_cache(cache_dir, key, destination_file, ttl=ttl):
+        print('\n* The result has been served from the cache.')
+        print('* The result has been exported to %s.\n' % (destination_file))
+        return
 
-            writer.writerow(row)
+    query_to_csv(**dict(arguments, cache_dir=None))
+    write_cache(cache_dir, key, destination_file, max_size=max_size)
+
+
+def query_to_csv(engine, host, user, port, password, database, query, headers=False, out_type='stdout', destination_file=None, delimiter=',', quotechar='"', print_info=1000, fetch_size=FETCH_SIZE, native_copy=False, parallel=1, split_column=None, part_files=False, workers=1, compress=None, compress_level=None, format_='csv', row_group_size=ROW_GROUP_SIZE, max_rows_per_file=None, max_bytes_per_file=None, resume=False, checkpoint_column=None, connection=None, pool=None, metrics_interval=None, metrics_file=None, prometheus_file=None, datetime_format=None, binary_format='hex', raw=False, cache_dir=None, cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE, freshness_query=None, watermark_column=None, state_file=None, memory_budget=None, write_buffer_size=FILE_BUFFER_SIZE, fsync=None, drop_cache=False):
+    """ Run a query and store the result to a CSV file """
+    """ `format_` can also be "parquet" or "arrow" for a destination file """
+
+    if watermark_column:
+        if format_ != 'csv' or native_copy or parallel > 1 or workers > 1 or max_rows_per_file or max_bytes_per_file or resume or raw or cache_dir:
+            raise RuntimeError(
+                'An incremental export cannot be combined with native COPY, a parallel export, workers, split files, a resumable export, raw values, the result cache or the "%s" format.' % (format_))
+        if out_type != 'file' and not state_file:
+            raise RuntimeError('An incremental export to stdout requires a state file.')
+
+        state_file = resolve_home_dir(
+            state_file or get_watermark_name(destination_file))
+        watermark_key = get_watermark_key(
+            engine, host, database, query, watermark_column)
+
+    if cache_dir:
+        return cached_query_to_csv(dict(locals()), cache_dir, ttl=cache_ttl,
+                                   max_size=cache_size, freshness_query=freshness_query)
+
+    if native_copy and not get_engine(engine).copy_to_csv:
+        raise RuntimeError(
+            'Native COPY is not supported by the "%s" engine.' % (engine))
+    if native_copy and (datetime_format or binary_format != 'hex'):
+        raise RuntimeError(
+            'Native COPY formats values itself, it cannot be combined with a datetime or binary format.')
+    if memory_budget and (native_copy or format_ != 'csv' or max_rows_per_file or max_bytes_per_file):
+        raise RuntimeError(
+            'A memory budget only applies to CSV exports, without native COPY or split files.')
+    if raw and (native_copy or format_ != 'csv' or datetime_format):
+        raise RuntimeError(
+            'Raw values can only be exported to CSV, without native COPY or a datetime format.')
+
+    if format_ != 'csv':
+        if out_type != 'file':
+            raise RuntimeError(
+                'The "%s" format requires a destination file.' % (format_))
+        if native_copy or parallel > 1:
+            raise RuntimeError(
+                'The "%s" format cannot be combined with native COPY or a parallel export.' % (format_))
+    elif compress and out_type != 'file':
+        raise RuntimeError('Compression requires a destination file.')
+    if (fsync or drop_cache) and (out_type != 'file' or format_ != 'csv'):
+        raise RuntimeError(
+            'A fsync policy or dropping written pages requires a CSV destination file.')
+    if fsync and fsync not in FSYNC_POLICIES:
+        raise RuntimeError('"%s" is not a fsync policy.' % (fsync))
+
+    split_files = max_rows_per_file or max_bytes_per_file
+    if split_files:
+        if out_type != 'file' or format_ != 'csv':
+            raise RuntimeError('Split files require a CSV destination file.')
+        if native_copy or parallel > 1 or workers > 1:
+            raise RuntimeError(
+                'Split files cannot be combined with native COPY, a parallel export or workers.')
+
+    if resume:
+        if not checkpoint_column:
+            raise RuntimeError('A resumable export requires a checkpoint column.')
+        if out_type != 'file' or format_ != 'csv' or split_files or get_compression(destination_file, compress):
+            raise RuntimeError(
+                'A resumable export requires an uncompressed CSV destination file.')
+        if native_copy or parallel > 1 or workers > 1:
+            raise RuntimeError(
+                'A resumable export cannot be combined with native COPY, a parallel export or workers.')
+
+    metrics = None
+    if metrics_interval or metrics_file or prometheus_file:
+        if parallel > 1:
+            raise RuntimeError('Metrics are not available for a parallel export.')
+        metrics = ExportMetrics(interval=metrics_interval)
+
+    if parallel > 1:
+        if not split_column:
+            raise RuntimeError('A parallel export requires a split column.')
+        if native_copy:
+            raise RuntimeError('Native COPY cannot run in parallel.')
+
+        return parallel_query_to_csv(
+            engine=engine,
+            host=host,
+            user=user,
+            port=port,
+            password=password,
+            database=database,
+            query=query,
+            split_column=split_column,
+            parallel=parallel,
+            headers=headers,
+            out_type=out_type,
+            destination_file=destination_file,
+            delimiter=delimiter,
+            quotechar=quotechar,
+            fetch_size=fetch_size,
+            part_files=part_files,
+            workers=workers,
+            compress=compress,
+            compress_level=compress_level,
+            datetime_format=datetime_format,
+            binary_format=binary_format,
+            memory_budget=memory_budget,
+            raw=raw,
+            write_buffer_size=write_buffer_size,
+            fsync=fsync,
+            drop_cache=drop_cache
+        )
+
+    # Get SQL connection
+    with borrow_connection(
+        connection=connection,
+        pool=pool,
+        engine=engine,
+        host=host,
+        user=user,
+        port=port,
+        password=password,
+        database=database,
+        raw=raw
+    ) as connection:
+        # COPY cannot run on a server-side cursor
+        cursor = get_cursor(connection, engine=None if native_copy else engine)
 
         if out_type == 'file':
+            print('\n* Exporting rows...')
+
+        if format_ != 'csv':
+            # Execute query
+            with timed(metrics, 'execute'):
+                execute_query(cursor=cursor, query=query)
+
+            write_columnar(
+                cursor,
+                resolve_home_dir(destination_file),
+                format_=format_,
+                engine=engine,
+                row_group_size=row_group_size,
+                compress=compress,
+                compress_level=compress_level,
+                print_info=print_info,
+                metrics=metrics
+            )
+        elif split_files:
+            # Execute query
+            with timed(metrics, 'execute'):
+                execute_query(cursor=cursor, query=query)
+
+            destination_file = resolve_home_dir(destination_file)
+            parts = write_parts(
+                cursor,
+                destination_file,
+                headers=headers,
+                delimiter=delimiter,
+                quotechar=quotechar,
+                fetch_size=fetch_size,
+                print_info=print_info,
+                engine=engine,
+                compress=compress,
+                compress_level=compress_level,
+                max_rows=max_rows_per_file,
+                max_bytes=max_bytes_per_file,
+                metrics=metrics,
+                datetime_format=datetime_format,
+                binary_format=binary_format,
+                raw=raw,
+                write_buffer_size=write_buffer_size,
+                fsync=fsync,
+                drop_cache=drop_cache
+            )
+            manifest = write_manifest(destination_file, parts)
+
+            print('  ...done')
+            print('* The result has been exported to %d files listed in %s.\n' %
+                  (len(parts), manifest))
+        elif resume:
+            write_resumable(
+                cursor,
+                query,
+                resolve_home_dir(destination_file),
+                checkpoint_column,
+                headers=headers,
+                delimiter=delimiter,
+                quotechar=quotechar,
+                fetch_size=fetch_size,
+                print_info=print_info,
+                engine=engine,
+                metrics=metrics,
+                datetime_format=datetime_format,
+                binary_format=binary_format,
+                raw=raw,
+                memory_budget=memory_budget,
+                write_buffer_size=write_buffer_size,
+                fsync=fsync,
+                drop_cache=drop_cache
+            )
+        else:
+            with open_stdout() if out_type == 'stdout' else open_file(resolve_home_dir(destination_file), compress=compress, compress_level=compress_level, write_buffer_size=write_buffer_size, fsync=fsync, drop_cache=drop_cache) as file_:
+                if native_copy:
+                    # The query runs and streams as a single COPY
+                    get_engine(engine).copy_to_csv(
+                        cursor=cursor, query=query, file_=file_, headers=headers,
+                        delimiter=delimiter, quotechar=quotechar, metrics=metrics)
+                elif watermark_column:
+                    watermark, count = export_delta(
+                        cursor,
+                        file_,
+                        query,
+                        watermark_column,
+                        watermark=read_watermark(state_file, watermark_key),
+                        headers=headers,
+                        delimiter=delimiter,
+                        quotechar=quotechar,
+                        lineterminator='\n' if out_type == 'stdout' else '\r\n',
+                        fetch_size=fetch_size,
+                        print_info=print_info if out_type == 'file' else None,
+                        engine=engine,
+                        metrics=metrics,
+                        datetime_format=datetime_format,
+                        binary_format=binary_format,
+                        memory_budget=memory_budget
+                    )
+                else:
+                    # Execute query
+                    with timed(metrics, 'execute'):
+                        execute_query(cursor=cursor, query=query)
+
+                    write_rows(
+                        cursor,
+                        file_,
+                        headers=headers,
+                        delimiter=delimiter,
+                        quotechar=quotechar,
+                        lineterminator='\n' if out_type == 'stdout' else '\r\n',
+                        fetch_size=fetch_size,
+                        print_info=print_info if out_type == 'file' else None,
+                        workers=workers,
+                        engine=engine,
+                        metrics=metrics,
+                        datetime_format=datetime_format,
+                        binary_format=binary_format,
+                        raw=raw,
+                        memory_budget=memory_budget
+                    )
+
+            # Only a complete delta moves the high-water mark
+            if watermark_column and watermark is not None:
+                write_watermark(state_file, watermark_key, watermark, count)
+
+        if out_type == 'file' and not split_files:
             print('  ...done')
             print('* The result has been exported to %s.\n' %
                   (destination_file))
 
-    # Print stdout
-    if out_type == 'stdout':
-        file_to_stdout()
+        cursor.close()
+
+    if metrics:
+        if metrics_interval:
+            metrics.emit('done')
+        if metrics_file:
+            metrics.write_summary(metrics_file)
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+
+
+def load_jobs(path, defaults=None):
+    """ Read a YAML or JSON job file and return a list of `query_to_csv()` arguments """
+    """ Job options override the file `defaults`, which override `defaults` """
+
+    with open(resolve_home_dir(path)) as file_:
+        if path.endswith('.json'):
+            content = json.load(file_)
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError(
+                    'YAML job files require the "PyYAML" package, use a JSON file instead.')
+
+            content = yaml.safe_load(file_)
+
+    # The file is either a list of jobs or {"defaults": {...}, "jobs": [...]}
+    if isinstance(content, list):
+        content = {'jobs': content}
+
+    jobs = []
+    for options in content.get('jobs') or []:
+        job = dict(defaults or {}, **(content.get('defaults') or {}))
+        job.update(options)
+
+        # Accept the CLI spelling of the output format
+        if 'format' in job:
+            job['format_'] = job.pop('format')
+
+        if not job.get('destination_file'):
+            raise RuntimeError('Every job requires a destination file.')
+        job['out_type'] = 'file'
+        job.setdefault('engine', 'mysql')
+        job.setdefault('host', '127.0.0.1')
+        job.setdefault('user', None)
+        job.setdefault('password', '')
+        engine = get_engine(job['engine'])
+        if not job.get('port'):
+            job['port'] = engine.default_port
+
+        required = ('user', 'database', 'query') if engine.server else ('database', 'query')
+        for key in required:
+            if not job.get(key):
+                raise RuntimeError('Job "%s" has no %s.' %
+                                   (job['destination_file'], key))
+
+        jobs.append(job)
+
+    return jobs, content.get('concurrency')
+
+
+def run_jobs(jobs, concurrency=4):
+    """ Run export jobs concurrently in threads """
+    """ Connections are shared between jobs through a `ConnectionPool` """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = ConnectionPool(max_size=concurrency)
+
+    failures = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(query_to_csv, pool=pool, **job)
+                       for job in jobs]
+            for job, future in zip(jobs, futures):
+                error = future.exception()
+                if error:
+                    failures += 1
+                    print('* Job "%s" failed: %s' %
+                          (job['destination_file'], error), file=sys.stderr)
+    finally:
+        pool.close()
+
+    if failures:
+        raise RuntimeError('%d of %d jobs failed.' % (failures, len(jobs)))
+
+
+def parse_size(size):
+    """ Parse a size in bytes with an optional KB, MB, GB or TB suffix """
+
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+    size = size.strip().upper()
+    for unit, multiplier in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * multiplier)
+
+    return int(size.rstrip('B'))
+
+
+def parse_positive_size(size):
+    """ Parse a size in bytes of at least 1 byte, see `parse_size()` """
+
+    import argparse
+
+    size = parse_size(size)
+    if size < 1:
+        raise argparse.ArgumentTypeError('must be at least 1 byte')
+
+    return size
 
 
 def main():
     """ Parses arguments and run module """
 
+    import argparse
+
     # Intercept and parse stdin input
     if has_stdin_input():
         # Parse arguments
@@ -275,25 +2958,30 @@ def main():
                             help="CSV delimiter", default=',')
         parser.add_argument("-Q", "--quotechar",
                             help="CSV quote character", default='"')
+        parser.add_argument("--input-format", type=str,
+                            choices=list(STDIN_PARSERS),
+                            help="Input format (default: detected)")
         args = parser.parse_args()
 
-        return stdin_to_csv(delimiter=args.delimiter, quotechar=args.quotechar)
+        return stdin_to_csv(delimiter=args.delimiter, quotechar=args.quotechar,
+                            input_format=args.input_format)
+
+    # Engines of installed plugins are valid choices
+    load_engine_plugins()
 
     # Parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("-e", "--engine", type=str, help="Database engine",
-                        choices=['mysql', 'postgresql'], default='mysql')
+                        choices=list(ENGINES), default='mysql')
     parser.add_argument("-H", "--host", default="127.0.0.1",
                         help="Database host")
     parser.add_argument("-P", "--port", type=int,
                         help="Database port")
-    parser.add_argument("-u", "--user", required=True, help="Database user")
+    parser.add_argument("-u", "--user", help="Database user")
     parser.add_argument("-p", "--password", default='',
                         help="Database password")
-    parser.add_argument("-d", "--database", required=True,
-                        help="Database name")
-    parser.add_argument("-q", "--query", required=True,
-                        help="SQL query")
+    parser.add_argument("-d", "--database", help="Database name")
+    parser.add_argument("-q", "--query", help="SQL query")
     parser.add_argument("-o", "--out",
                         help="CSV destination", choices=['stdout', 'file'],
                         default='stdout')
@@ -304,14 +2992,89 @@ def main():
                         help="CSV quote character", default='"')
     parser.add_argument("-t", "--headers", action='store_true',
                         help="Include headers")
+    parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE,
+                        help="Number of rows fetched per round-trip")
+    parser.add_argument("--write-buffer-size", type=parse_positive_size, default=FILE_BUFFER_SIZE,
+                        help="Size of the chunks written to the destination file by a background thread (default: 8MB)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES,
+                        help="Sync the destination file once written (close) or after each chunk (chunk)")
+    parser.add_argument("--drop-cache", action='store_true',
+                        help="Drop the written pages from the page cache (posix_fadvise DONTNEED)")
+    parser.add_argument("--memory-budget", type=parse_size,
+                        help="Memory for each batch of rows (e.g. 256MB), fetch sizes adapt to the row width instead of --fetch-size")
+    parser.add_argument("--native-copy", action='store_true',
+                        help="Let the database generate the CSV (PostgreSQL COPY, MySQL CONCAT_WS)")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="Number of concurrent connections")
+    parser.add_argument("--split-column",
+                        help="Numeric or date column used to split a parallel export")
+    parser.add_argument("--part-files", action='store_true',
+                        help="Keep one file per parallel chunk")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes encoding rows to CSV")
+    parser.add_argument("--compress", choices=['gzip', 'zstd', 'lz4'],
+                        help="Compress the destination file (inferred from a .gz, .zst or .lz4 extension)")
+    parser.add_argument("--compress-level", type=int,
+                        help="Compression level")
+    parser.add_argument("--format", choices=['csv', 'parquet', 'arrow'],
+                        default='csv', help="Output format")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE,
+                        help="Rows per Parquet row group or Arrow record batch")
+    parser.add_argument("--max-rows-per-file", type=int,
+                        help="Split the output into part files of at most this many rows")
+    parser.add_argument("--max-bytes-per-file", type=parse_size,
+                        help="Split the output into part files of about this size (e.g. 512MB)")
+    parser.add_argument("--resume", action='store_true',
+                        help="Resume an interrupted export from its last checkpoint")
+    parser.add_argument("--checkpoint-column",
+                        help="Unique, increasing column used to resume an export")
+    parser.add_argument("--metrics-interval", type=float,
+                        help="Write export metrics to stderr as JSON lines every this many seconds")
+    parser.add_argument("--metrics-file",
+                        help="Write a JSON summary of the export metrics to this file")
+    parser.add_argument("--prometheus-file",
+                        help="Write the export metrics to this Prometheus textfile")
+    parser.add_argument("--datetime-format",
+                        help="strftime() format of datetime values (default: ISO 8601, e.g. 2018-12-01 12:23:12)")
+    parser.add_argument("--binary-format", choices=['hex', 'base64'],
+                        default='hex', help="Encoding of binary values")
+    parser.add_argument("--raw", action='store_true',
+                        help="Write values as sent by the database, without decoding them")
+    parser.add_argument("--cache-dir",
+                        help="Serve repeated queries from a result cache in this directory")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL,
+                        help="Seconds a cached result is served for (default: %d)" % CACHE_TTL)
+    parser.add_argument("--cache-size", type=parse_size, default=CACHE_SIZE,
+                        help="Size of the result cache before the least recently used results are evicted (default: 1GB)")
+    parser.add_argument("--freshness-query",
+                        help="Cheap query whose result invalidates the cache when it changes (e.g. SELECT max(updated_at) FROM t)")
+    parser.add_argument("--watermark-column",
+                        help="Only export rows with this column above the value recorded by the previous run")
+    parser.add_argument("--state-file",
+                        help="File recording the watermark of incremental exports (default: destination file + .watermark.json)")
+    parser.add_argument("--jobs",
+                        help="YAML or JSON file listing queries and destination files")
+    parser.add_argument("--concurrency", type=int,
+                        help="Number of jobs running at once (default: 4)")
     args = parser.parse_args()
 
+    if args.jobs:
+        # Connection arguments are defaults for every job
+        defaults = {key: value for key, value in vars(args).items()
+                    if key in CONNECTION_KEYS and value}
+        jobs, concurrency = load_jobs(args.jobs, defaults=defaults)
+
+        return run_jobs(jobs, concurrency=args.concurrency or concurrency or 4)
+
+    required = ('user', 'database', 'query') if get_engine(args.engine).server else ('database', 'query')
+    missing = [name for name in required if not getattr(args, name)]
+    if missing:
+        parser.error('the following arguments are required: %s' %
+                     ', '.join('--' + name for name in missing))
+
     # Set default port
     if not args.port:
-        if args.engine == 'postgresql':
-            args.port = 5432  # PG default
-        else:
-            args.port = 3306  # MySQL default
+        args.port = get_engine(args.engine).default_port
 
     # Force output to file if there is a file
     if args.destination_file:
@@ -329,7 +3092,37 @@ def main():
         out_type=args.out,
         destination_file=args.destination_file,
         delimiter=args.delimiter,
-        quotechar=args.quotechar
+        quotechar=args.quotechar,
+        fetch_size=args.fetch_size,
+        native_copy=args.native_copy,
+        parallel=args.parallel,
+        split_column=args.split_column,
+        part_files=args.part_files,
+        workers=args.workers,
+        compress=args.compress,
+        compress_level=args.compress_level,
+        format_=args.format,
+        row_group_size=args.row_group_size,
+        max_rows_per_file=args.max_rows_per_file,
+        max_bytes_per_file=args.max_bytes_per_file,
+        resume=args.resume,
+        checkpoint_column=args.checkpoint_column,
+        metrics_interval=args.metrics_interval,
+        metrics_file=args.metrics_file,
+        prometheus_file=args.prometheus_file,
+        datetime_format=args.datetime_format,
+        binary_format=args.binary_format,
+        raw=args.raw,
+        cache_dir=args.cache_dir,
+        cache_ttl=args.cache_ttl,
+        cache_size=args.cache_size,
+        freshness_query=args.freshness_query,
+        watermark_column=args.watermark_column,
+        state_file=args.state_file,
+        memory_budget=args.memory_budget,
+        write_buffer_size=args.write_buffer_size,
+        fsync=args.fsync,
+        drop_cache=args.drop_cache
     )
 
 
@@ -1,16 +1,64 @@
 import unittest
 import _io
-import tempfile
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
 import sys
-from unittest.mock import patch
-from io import StringIO
+import threading
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+from io import StringIO, BytesIO, TextIOBase, TextIOWrapper
 
 import psycopg2
 import pymysql
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 from .. import sql2csv
 
 
+class FakeConnection():
+    """ DB-API connection stub counting pings and rollbacks """
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.pings = 0
+        self.rollbacks = 0
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if not self.alive:
+            raise pymysql.err.OperationalError('Gone away')
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor():
+    """ DB-API cursor stub returning `rows` in batches, recording their sizes """
+
+    def __init__(self, rows, description=(('id', None), ('name', None))):
+        self.rows = list(rows)
+        self.description = list(description)
+        self.sizes = []
+
+    def fetchmany(self, size):
+        self.sizes.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
 class Test(unittest.TestCase):
 
     db_configs = {
@@ -29,13 +77,32 @@ class Test(unittest.TestCase):
             'user': 'db_user',
             'password': 'db_password',
             'db': 'my_db'
+        },
+        'sqlite': {
+            'engine': 'sqlite',
+            'host': None,
+            'port': None,
+            'user': None,
+            'password': None,
+            'db': '/tmp/sql2csv.sqlite'
         }
     }
 
+    @classmethod
+    def setUpClass(cls):
+        # SQLite database from the schema, no server needed
+        path = cls.db_configs['sqlite']['db']
+        if os.path.exists(path):
+            os.remove(path)
+        with open(os.path.join(os.path.dirname(__file__), '../../schema/sqlite.sql')) as f:
+            connection = sqlite3.connect(path)
+            connection.executescript(f.read())
+            connection.close()
+
     def get_connection(self, engine):
 
         db_config = self.db_configs[
-            'pg' if engine == 'postgresql' else 'mysql'
+            {'postgresql': 'pg', 'sqlite': 'sqlite'}.get(engine, 'mysql')
         ]
 
         # Get database connection
@@ -71,6 +138,41 @@ class Test(unittest.TestCase):
 
         self.assertIsInstance(connection, psycopg2.extensions.connection)
 
+    def test_get_mysql_connection_raw(self):
+        db_config = self.db_configs['mysql']
+
+        connection = sql2csv.get_mysql_connection(
+            db_config['host'], db_config['user'], db_config['port'], db_config['password'], db_config['db'], raw=True)
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1, 1.50, CAST('2018-12-01 12:23:12' AS DATETIME)")
+
+        # Values are not decoded
+        assert cursor.fetchone() == ('1', '1.50', '2018-12-01 12:23:12')
+
+    def test_get_pg_connection_raw(self):
+        db_config = self.db_configs['pg']
+
+        connection = sql2csv.get_pg_connection(
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            raw=True
+        )
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1, 1.50, '2018-12-01 12:23:12'::timestamp, true")
+
+        # Values are not decoded
+        assert cursor.fetchone() == ('1', '1.50', '2018-12-01 12:23:12', 't')
+
+    def test_get_connection_raw_unsupported(self):
+        db_config = self.db_configs['sqlite']
+
+        self.assertRaises(RuntimeError, sql2csv.get_connection, engine='sqlite',
+                          host=db_config['host'], user=db_config['user'], port=db_config['port'],
+                          password=db_config['password'], database=db_config['db'], raw=True)
+
     def test_get_connection_engine_mysql(self):
         # Get database connection
         connection = self.get_connection(
@@ -87,6 +189,67 @@ class Test(unittest.TestCase):
 
         self.assertIsInstance(connection, psycopg2.extensions.connection)
 
+    def test_get_connection_engine_sqlite(self):
+        # Get database connection
+        connection = self.get_connection(
+            engine='sqlite'
+        )
+
+        self.assertIsInstance(connection, sqlite3.Connection)
+
+    def test_sqlite_cursor_params(self):
+        cursor = self.get_connection(engine='sqlite').cursor()
+
+        # `%s` placeholders and `%%` escapes are translated
+        cursor.execute(
+            "SELECT id FROM some_sqlite_table WHERE some_str LIKE 'hello%%' AND id > %s", (1,))
+        assert cursor.fetchall() == [(2,)]
+
+        # Queries without parameters are left as they are
+        cursor.execute("SELECT id FROM some_sqlite_table WHERE some_str LIKE 'hello%'")
+        assert cursor.fetchall() == [(1,), (2,)]
+
+    def test_get_engine(self):
+        assert sql2csv.get_engine('postgresql').copy_to_csv is sql2csv.copy_to_csv
+        assert sql2csv.get_engine('mysql').default_port == 3306
+        assert sql2csv.get_engine('sqlite').server is False
+
+        self.assertRaises(RuntimeError, sql2csv.get_engine, 'invalid')
+
+    def test_register_engine(self):
+        sql2csv.register_engine(sql2csv.Engine(
+            'other_sqlite', sql2csv.get_sqlite_connection, server=False))
+        try:
+            sql2csv.query_to_csv(
+                engine='other_sqlite',
+                host=None,
+                user=None,
+                port=None,
+                password=None,
+                database=self.db_configs['sqlite']['db'],
+                query='SELECT id FROM some_sqlite_table',
+                out_type='file',
+                destination_file='/tmp/file_other_sqlite'
+            )
+        finally:
+            del sql2csv.ENGINES['other_sqlite']
+
+        with open('/tmp/file_other_sqlite') as content_file:
+            assert content_file.read() == '1\n2\n3\n'
+
+    def test_load_engine_plugins(self):
+        class EntryPoint:
+            name = 'plugin_sqlite'
+
+            def load(self):
+                return lambda: sql2csv.Engine('plugin_sqlite', sql2csv.get_sqlite_connection)
+
+        with patch('importlib.metadata.entry_points', lambda: {'sql2csv.engines': [EntryPoint()]}):
+            try:
+                assert sql2csv.get_engine('plugin_sqlite').name == 'plugin_sqlite'
+            finally:
+                sql2csv.ENGINES.pop('plugin_sqlite', None)
+
     def test_get_connection_engine_invalid_engine(self):
         db_config = self.db_configs['pg']
 
@@ -146,6 +309,149 @@ class Test(unittest.TestCase):
         for row in sql2csv.fetch_rows(cursor=cursor):
             self.assertIsInstance(row, tuple)
 
+    def test_get_cursor_streaming_mysql(self):
+        # Get database connection
+        connection = self.get_connection(
+            engine='mysql'
+        )
+
+        cursor = sql2csv.get_cursor(connection, engine='mysql')
+
+        self.assertIsInstance(cursor, pymysql.cursors.SSCursor)
+
+    def test_get_cursor_streaming_postgresql(self):
+        # Get database connection
+        connection = self.get_connection(
+            engine='postgresql'
+        )
+
+        cursor = sql2csv.get_cursor(connection, engine='postgresql')
+
+        assert cursor.name == 'sql2csv'
+
+    def test_fetch_batches_mysql(self):
+        # Get database connection
+        connection = self.get_connection(
+            engine='mysql'
+        )
+
+        cursor = sql2csv.get_cursor(connection, engine='mysql')
+        sql2csv.execute_query(
+            cursor=cursor, query='SELECT * FROM some_mysql_table')
+
+        batches = list(sql2csv.fetch_batches(cursor=cursor, fetch_size=2))
+        assert [len(batch) for batch in batches] == [2, 1]
+
+    def test_fetch_batches_postgresql(self):
+        # Get database connection
+        connection = self.get_connection(
+            engine='postgresql'
+        )
+
+        cursor = sql2csv.get_cursor(connection, engine='postgresql')
+        sql2csv.execute_query(
+            cursor=cursor, query='SELECT generate_series(1, 5);')
+
+        batches = list(sql2csv.fetch_batches(cursor=cursor, fetch_size=2))
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+
+    def test_wrap_query(self):
+        assert sql2csv.wrap_query('SELECT * FROM t WHERE a LIKE "b%";') == \
+            'SELECT * FROM (SELECT * FROM t WHERE a LIKE "b%%") AS sql2csv_src'
+        assert sql2csv.wrap_query('SELECT 1', ['a > %s', 'b < %s']) == \
+            'SELECT * FROM (SELECT 1) AS sql2csv_src WHERE a > %s AND b < %s'
+
+    def test_start_shared_snapshot_mysql(self):
+        calls = MagicMock()
+        connection = calls.connection
+        connections = [calls.chunk1, calls.chunk2]
+
+        sql2csv.start_shared_snapshot(connection, connections, 'mysql')
+
+        # Every snapshot starts while writes are blocked
+        queries = [(name.split('.')[0], args[0]) for name, args, _ in calls.mock_calls
+                   if name.endswith('cursor().execute')]
+        assert queries == [
+            ('connection', 'FLUSH TABLES WITH READ LOCK'),
+            ('connection', 'START TRANSACTION WITH CONSISTENT SNAPSHOT'),
+            ('chunk1', 'START TRANSACTION WITH CONSISTENT SNAPSHOT'),
+            ('chunk2', 'START TRANSACTION WITH CONSISTENT SNAPSHOT'),
+            ('connection', 'UNLOCK TABLES')
+        ]
+
+    def test_split_range(self):
+        assert sql2csv.split_range(1, 100, 4) == [25, 50, 75]
+        assert sql2csv.split_range(1, 2, 4) == []
+        assert sql2csv.split_range(5, 5, 4) == []
+        assert sql2csv.split_range(0.0, 1.0, 2) == [0.5]
+        assert sql2csv.split_range(
+            date(2020, 1, 1), date(2020, 1, 5), 2) == [date(2020, 1, 3)]
+
+    def test_split_range_invalid_type(self):
+        self.assertRaises(RuntimeError, sql2csv.split_range, 'a', 'b', 2)
+
+    def test_get_chunk_filters(self):
+        assert sql2csv.get_chunk_filters('id', []) == [([], ())]
+        assert sql2csv.get_chunk_filters('id', [10, 20]) == [
+            (['(id < %s OR id IS NULL)'], (10,)),
+            (['id >= %s', 'id < %s'], (10, 20)),
+            (['id >= %s'], (20,))
+        ]
+
+    def test_get_copy_query(self):
+        assert sql2csv.get_copy_query('SELECT 1;') == \
+            "COPY (SELECT 1) TO STDOUT WITH (FORMAT csv, HEADER false, DELIMITER ',', QUOTE '\"')"
+        assert sql2csv.get_copy_query('SELECT 1', headers=True, delimiter=';', quotechar="'") == \
+            "COPY (SELECT 1) TO STDOUT WITH (FORMAT csv, HEADER true, DELIMITER ';', QUOTE '''')"
+
+    def test_copy_to_csv_metrics(self):
+        class Cursor:
+            rowcount = -1
+
+            def copy_expert(self, query, file_):
+                # Like psycopg2, text is only written to text files
+                for line in ['1,héllo\n', '2,world\n']:
+                    file_.write(line if isinstance(file_, TextIOBase) else line.encode('utf-8'))
+                self.rowcount = 2
+
+        file_ = StringIO()
+        metrics = sql2csv.ExportMetrics()
+        sql2csv.copy_to_csv(Cursor(), 'SELECT 1', file_, metrics=metrics)
+
+        # Rows and bytes written by the driver are counted
+        assert file_.getvalue() == '1,héllo\n2,world\n'
+        assert metrics.rows == 2
+        assert metrics.bytes == 17
+
+    def test_get_mysql_copy_query(self):
+        class Field:
+            def __init__(self, name, type_code, charsetnr=45):
+                self.name, self.type_code, self.charsetnr = name, type_code, charsetnr
+
+        fields = [Field('id', pymysql.constants.FIELD_TYPE.LONG, 63),
+                  Field('na`me', pymysql.constants.FIELD_TYPE.VAR_STRING),
+                  Field('raw', pymysql.constants.FIELD_TYPE.BLOB, 63)]
+
+        query = sql2csv.get_mysql_copy_query('SELECT 1;', fields, sql2csv.quote_literal)
+
+        assert query.startswith("SELECT CONCAT_WS(',', IFNULL(sql2csv_src.`id`, ''), IFNULL(IF(LOCATE(',', sql2csv_src.`na``me`)")
+        assert query.endswith(", IFNULL(LOWER(HEX(sql2csv_src.`raw`)), '')) FROM (SELECT 1) AS sql2csv_src")
+
+        # Numbers are checked for quotes when the delimiter could be in them
+        query = sql2csv.get_mysql_copy_query('SELECT 1', fields[:1], sql2csv.quote_literal, delimiter='.')
+        assert 'LOCATE' in query
+
+        # Every binary column is written as hex, not only binary strings
+        fields = [Field('flags', pymysql.constants.FIELD_TYPE.BIT, 63),
+                  Field('shape', pymysql.constants.FIELD_TYPE.GEOMETRY, 63),
+                  Field('doc', pymysql.constants.FIELD_TYPE.JSON, 63)]
+
+        query = sql2csv.get_mysql_copy_query('SELECT 1', fields, sql2csv.quote_literal)
+
+        assert 'LOWER(HEX(sql2csv_src.`flags`))' in query
+        assert 'LOWER(HEX(sql2csv_src.`shape`))' in query
+        assert 'HEX(sql2csv_src.`doc`)' not in query
+
     def test_fetch_headers_mysql(self):
         # Get database connection
         connection = self.get_connection(
@@ -170,34 +476,67 @@ class Test(unittest.TestCase):
 
         assert sql2csv.fetch_headers(cursor=cursor) == ['column1', 'column2']
 
-    def test_discard_line(self):
-        assert sql2csv.discard_line('+something') is True
-        assert sql2csv.discard_line('(something') is True
-        assert sql2csv.discard_line('-something') is True
-        assert sql2csv.discard_line('') is True
-        assert sql2csv.discard_line('something') is False
+    def test_sniff_format(self):
+        assert sql2csv.sniff_format(['id\tname', '1\ta']) == 'mysql-batch'
+        assert sql2csv.sniff_format(
+            ['+----+', '| id |', '+----+']) == 'mysql-table'
+        assert sql2csv.sniff_format(
+            [' id | name', '----+------', '  1 | a']) == 'psql-aligned'
+        assert sql2csv.sniff_format(
+            ['id|name', '1|a', '(1 row)']) == 'psql-unaligned'
+        assert sql2csv.sniff_format(['id', '1', '(1 row)']) == 'psql-unaligned'
+        assert sql2csv.sniff_format(
+            ['-[ RECORD 1 ]---', 'id | 1']) == 'psql-expanded'
+        assert sql2csv.sniff_format(['', 'id']) == 'mysql-batch'
+        assert sql2csv.sniff_format([]) == 'mysql-batch'
 
-    def test_remove_leading_trailing_pipe(self):
-        assert sql2csv.remove_leading_trailing_pipe(
-            '|something|') == 'something'
-        assert sql2csv.remove_leading_trailing_pipe('something') == 'something'
+    def test_parse_mysql_batch(self):
+        rows = list(sql2csv.parse_mysql_batch([['id\tname', '-1\t a ', '']]))
 
-    def test_get_column_separator(self):
-        assert (sql2csv.get_column_separator('some|value|is\nseparated')) == '|'
-        assert (sql2csv.get_column_separator(
-            'some\tvalue\tis|separated')) == '\t'
+        assert rows == [[['id', 'name'], ['-1', ' a ']]]
 
-    def test_split_columns(self):
-        assert sql2csv.split_columns(
-            'some\tthing\telse') == ['some', 'thing', 'else']
+    def test_parse_mysql_table(self):
+        rows = list(sql2csv.parse_mysql_table(
+            [['+----+------+', '| id | name |', '+----+------+',
+              '| -1 | a    |', '+----+------+', '1 row in set']]))
 
-    def test_split_columns_2(self):
-        assert sql2csv.split_columns(
-            'some|thing|else', separator='|') == ['some', 'thing', 'else']
+        assert rows == [[['id', 'name'], ['-1', 'a']]]
 
-    def test_strip_whitespaces(self):
-        assert sql2csv.strip_whitespaces(
-            ['  some  ', '  thing', 'else  ']) == ['some', 'thing', 'else']
+    def test_parse_psql_aligned(self):
+        rows = list(sql2csv.parse_psql_aligned(
+            [[' id | name', '----+------', ' -1 | a', '(1 row)', '']]))
+
+        assert rows == [[['id', 'name'], ['-1', 'a']]]
+
+    def test_parse_psql_unaligned(self):
+        rows = list(sql2csv.parse_psql_unaligned(
+            [['id|name', '-1|a', '(1 row)']]))
+
+        assert rows == [[['id', 'name'], ['-1', 'a']]]
+
+    def test_parse_psql_expanded(self):
+        # Records spread over several blocks
+        rows = list(sql2csv.parse_psql_expanded(
+            [['-[ RECORD 1 ]---', 'id   | 1', 'name | a|b'],
+             ['-[ RECORD 2 ]---', 'id   | -2'], ['name | ']]))
+
+        assert [row for block in rows for row in block] == [
+            ['id', 'name'], ['1', 'a|b'], ['-2', '']]
+
+    def test_read_lines(self):
+        # Multibyte character split across blocks, no trailing newline
+        stream = BytesIO('ab\ncdé\nfg'.encode('utf-8'))
+        lines = [line for block in sql2csv.read_lines(stream, block_size=5)
+                 for line in block]
+
+        assert lines == ['ab', 'cdé', 'fg']
+
+    def test_read_lines_text(self):
+        stream = StringIO('ab\ncd\n')
+        lines = [line for block in sql2csv.read_lines(stream, block_size=3)
+                 for line in block]
+
+        assert lines == ['ab', 'cd']
 
     def test_stringify_items(self):
         # No change expected
@@ -208,6 +547,215 @@ class Test(unittest.TestCase):
         assert sql2csv.stringify_items((1, 2, {'a': True, 'b': False, 'c': 'some string'})) == (
             1, 2, '{"a": true, "b": false, "c": "some string"}')
 
+    def test_get_converters_arrays(self):
+        class Cursor:
+            description = [('tags', 1009), ('doc', 3802)]
+
+        # PostgreSQL arrays keep their `str()` format, JSON arrays are encoded
+        rows = [(['a', 'b'], ['a', 'b'])]
+        converters = sql2csv.get_converters(Cursor, engine='postgresql', rows=rows)
+        assert converters[0] is None
+        assert sql2csv.convert_rows(rows, converters) == [[['a', 'b'], '["a", "b"]']]
+
+    def test_get_converters(self):
+        class Cursor:
+            description = [('id', 23), ('data', 3802), ('doc', 114)]
+
+        assert sql2csv.get_converters(Cursor, engine='postgresql') == [
+            None, sql2csv.format_json, sql2csv.format_json]
+        assert sql2csv.get_converters(Cursor, engine='mysql') == [
+            None, None, None]
+
+        # Unknown engines check every column
+        assert sql2csv.get_converters(Cursor) == [
+            sql2csv.stringify_item] * 3
+
+    def test_get_converters_formatters(self):
+        class Cursor:
+            description = [('id', 23), ('day', 1082), ('price', 1700),
+                           ('raw', 17), ('created', 1114), ('other', 0)]
+
+        rows = [(i, date(2018, 12, 1), Decimal('1E-8'), b'\x01\xff',
+                 datetime(2018, 12, 1, 12, 23) + timedelta(seconds=i), b'ab')
+                for i in range(sql2csv.FORMAT_CACHE_SAMPLE)]
+
+        converters = sql2csv.get_converters(
+            Cursor, engine='postgresql', rows=rows, binary_format='base64')
+
+        # Repeated dates are formatted once
+        assert converters[0] is None
+        assert isinstance(converters[1].__self__, sql2csv.FormatCache)
+        assert converters[2] == sql2csv.format_decimal
+        assert converters[3](b'\x01\xff') == 'Af8='
+        assert converters[4] is None  # `str()` already formats distinct datetimes
+        assert converters[5](b'ab') == 'YWI='  # Detected from the values
+
+        assert sql2csv.convert_rows(rows[:1], converters) == [
+            [0, '2018-12-01', '0.00000001', 'Af8=', datetime(2018, 12, 1, 12, 23), 'YWI=']]
+
+        converters = sql2csv.get_converters(
+            Cursor, engine='postgresql', rows=rows, datetime_format='%Y-%m-%dT%H:%M:%S')
+        assert converters[4](datetime(2018, 12, 1, 12, 23)) == '2018-12-01T12:23:00'
+
+    def test_get_converters_equal_values(self):
+        class Cursor:
+            description = [('price', 1700), ('created', 1184)]
+
+        utc, paris = timezone.utc, timezone(timedelta(hours=1))
+        rows = [(Decimal('0.1'), datetime(2018, 12, 1, 12, tzinfo=utc)),
+                (Decimal('0.10'), datetime(2018, 12, 1, 13, tzinfo=paris)),
+                (Decimal('0.1'), datetime(2018, 12, 1, 12, tzinfo=utc)),
+                (Decimal('0.100'), datetime(2018, 12, 1, 13, tzinfo=paris))]
+
+        # Equal values printing differently keep their own text
+        converters = sql2csv.get_converters(
+            Cursor, engine='postgresql', rows=rows, datetime_format='%H:%M%z')
+        assert sql2csv.convert_rows(rows, converters) == [
+            ['0.1', '12:00+0000'], ['0.10', '13:00+0100'],
+            ['0.1', '12:00+0000'], ['0.100', '13:00+0100']]
+
+    def test_get_converters_small_sample(self):
+        class Cursor:
+            description = [('day', 1082)]
+
+        # Too few values to tell a low-cardinality column
+        rows = [(date(2018, 12, 1),)] * 10
+        assert sql2csv.get_converters(Cursor, engine='postgresql', rows=rows) == [None]
+
+    def test_get_converters_null_sample(self):
+        class Cursor:
+            description = [('id', 3), ('data', 252), ('name', 253)]
+
+        # Only NULL values in the first batch: each value is checked
+        rows = [(1, None, None), (2, None, None)]
+        converters = sql2csv.get_converters(Cursor, engine='mysql', rows=rows)
+        assert converters[0] is None
+        assert sql2csv.convert_rows([(3, b'\x05', {'a': 1})], converters) == [
+            [3, '05', '{"a": 1}']]
+        assert sql2csv.convert_rows([(4, 'text', Decimal('1E-8'))], converters) == [
+            [4, 'text', '0.00000001']]
+
+    def test_get_converters_raw(self):
+        class Cursor:
+            description = [('id', 23), ('day', 1082), ('price', 1700), ('data', 3802)]
+
+        # Columns returned as text in raw mode need no converter, but JSON
+        # columns keep theirs
+        rows = [('1', '2018-12-01', '1.50', '{"a": 1}')] * 4
+        assert sql2csv.get_converters(Cursor, engine='postgresql', rows=rows, raw=True) == [
+            None, None, None, sql2csv.format_json]
+
+        # Outside raw mode, a JSON string scalar does not hide later objects
+        rows = [(1, date(2018, 12, 1), Decimal('1.50'), 'a')]
+        converters = sql2csv.get_converters(Cursor, engine='postgresql', rows=rows)
+        assert converters[3] == sql2csv.format_json
+        assert sql2csv.convert_rows([(2, None, None, {'a': 1})], converters)[0][3] == '{"a": 1}'
+
+    def test_formatters(self):
+        assert sql2csv.format_datetime(datetime(2018, 12, 1, 12, 23, 12)) == '2018-12-01 12:23:12'
+        assert sql2csv.format_datetime(
+            datetime(2018, 12, 1, 12, 23, 12), datetime_format='%d/%m/%Y') == '01/12/2018'
+        assert sql2csv.format_date(date(2018, 12, 1)) == '2018-12-01'
+        assert sql2csv.format_decimal(Decimal('0E-10')) == '0.0000000000'
+        assert sql2csv.format_decimal(Decimal('1.50')) == '1.50'
+        assert sql2csv.format_binary(memoryview(b'\x00\x10')) == '0010'
+        assert sql2csv.format_binary(b'ab', binary_format='base64') == 'YWI='
+
+        # Other values are left as they are
+        for formatter in (sql2csv.format_datetime, sql2csv.format_date,
+                          sql2csv.format_decimal, sql2csv.format_binary):
+            assert formatter(None) is None
+            assert formatter('0000-00-00') == '0000-00-00'
+
+    def test_format_cache(self):
+        calls = []
+
+        def formatter(item):
+            calls.append(item)
+            return str(item)
+
+        cache = sql2csv.FormatCache(formatter, max_size=2)
+
+        assert [cache[item] for item in (1, 1, 2, 1)] == ['1', '1', '2', '1']
+        assert calls == [1, 2]
+
+        # The cache is emptied when full
+        assert cache[3] == '3'
+        assert len(cache) == 1
+
+    def test_convert_rows(self):
+        rows = [(1, {'a': True}), (2, None)]
+
+        assert sql2csv.convert_rows(rows, [None, None]) is rows
+        assert sql2csv.convert_rows(rows, [None, sql2csv.stringify_item]) == [
+            [1, '{"a": true}'], [2, None]]
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_get_arrow_schema(self):
+        class Cursor:
+            description = [
+                ('id', 23, None, None, None, None, None),
+                ('price', 1700, None, None, 10, 2, None),
+                ('ratio', 1700, None, None, None, None, None),
+                ('created', 1114, None, None, None, None, None),
+                ('data', 3802, None, None, None, None, None),
+                ('other', 0, None, None, None, None, None)
+            ]
+
+        schema = sql2csv.get_arrow_schema(
+            pyarrow, Cursor, [(1, None, None, None, None, 1.5)], engine='postgresql')
+
+        assert schema.types == [
+            pyarrow.int64(),
+            pyarrow.decimal128(10, 2),
+            pyarrow.string(),
+            pyarrow.timestamp('us'),
+            pyarrow.string(),
+            pyarrow.float64()  # Inferred from the rows
+        ]
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_rows_to_record_batch(self):
+        schema = pyarrow.schema([
+            ('id', pyarrow.int64()),
+            ('data', pyarrow.string()),
+            ('raw', pyarrow.binary())
+        ])
+        rows = [(1, {'a': True}, memoryview(b'ab')), (2, None, None)]
+
+        batch = sql2csv.rows_to_record_batch(pyarrow, rows, schema)
+
+        assert batch.to_pylist() == [
+            {'id': 1, 'data': '{"a": true}', 'raw': b'ab'},
+            {'id': 2, 'data': None, 'raw': None}
+        ]
+
+    def test_to_text(self):
+        assert sql2csv.to_text(None) is None
+        assert sql2csv.to_text('a') == 'a'
+        assert sql2csv.to_text({'a': 1}) == '{"a": 1}'
+        assert sql2csv.to_text(b'ab') == 'ab'
+        self.assertRaises(UnicodeDecodeError, sql2csv.to_text, b'\xff')
+        assert sql2csv.to_text(Decimal('1.50')) == '1.50'
+
+    def test_encode_rows(self):
+        assert sql2csv.encode_rows([(1, 'a,b', {'c': 1}), (2, None, 'd')]) == \
+            '1,"a,b","{""c"": 1}"\r\n2,,d\r\n'
+        assert sql2csv.encode_rows(
+            [(1, 'a')], delimiter=';', lineterminator='\n') == '1;a\n'
+
+    def test_write_batches_pipelined(self):
+        batches = [[(i, 'row %d' % i, {'i': i}) for i in range(j, j + 10)]
+                   for j in range(0, 100, 10)]
+
+        out = StringIO()
+        count = sql2csv.write_batches_pipelined(iter(batches), out, workers=2)
+
+        # Output is identical to the serial encoding
+        assert count == 100
+        assert out.getvalue() == ''.join(
+            sql2csv.encode_rows(rows) for rows in batches)
+
     @patch('sys.stdin.isatty')
     def test_has_stdin_input(self, mocked):
         mocked.return_value = True
@@ -226,36 +774,490 @@ class Test(unittest.TestCase):
         self.assertIsInstance(sql2csv.open_file(
             '/tmp/file1'), _io.TextIOWrapper)
 
-    def test_open_tempfile(self):
-        self.assertIsInstance(sql2csv.open_tempfile(),
-                              tempfile._TemporaryFileWrapper)
+    def test_open_file_gzip(self):
+        with sql2csv.open_file('/tmp/file1.csv.gz') as file_:
+            file_.write('some line\r\n')
+
+        with gzip.open('/tmp/file1.csv.gz', 'rb') as f:
+            assert f.read() == b'some line\r\n'
+
+    def test_open_file_compress(self):
+        with sql2csv.open_file('/tmp/file1', compress='gzip', compress_level=1) as file_:
+            file_.write('some line')
+
+        with gzip.open('/tmp/file1', 'rt') as f:
+            assert f.read() == 'some line'
+
+    def test_open_file_invalid_compression(self):
+        self.assertRaises(RuntimeError, sql2csv.open_file,
+                          '/tmp/file1', compress='invalid')
+
+    def test_get_compression(self):
+        assert sql2csv.get_compression('/tmp/file.csv') is None
+        assert sql2csv.get_compression('/tmp/file.csv.gz') == 'gzip'
+        assert sql2csv.get_compression('/tmp/file.csv.zst') == 'zstd'
+        assert sql2csv.get_compression('/tmp/file.csv.lz4') == 'lz4'
+        assert sql2csv.get_compression('/tmp/file.csv', 'lz4') == 'lz4'
+
+    def test_get_part_name(self):
+        assert sql2csv.get_part_name(
+            '/tmp/export.csv', 1) == '/tmp/export-00001.csv'
+        assert sql2csv.get_part_name(
+            '/tmp/export.csv.gz', 12) == '/tmp/export-00012.csv.gz'
+
+    def test_get_manifest_name(self):
+        assert sql2csv.get_manifest_name(
+            '/tmp/export.csv') == '/tmp/export.manifest.json'
+        assert sql2csv.get_manifest_name(
+            '/tmp/export.csv.gz') == '/tmp/export.manifest.json'
+
+    def test_checksum_writer(self):
+        with sql2csv.ChecksumWriter(open('/tmp/file1', 'wb')) as checksum:
+            checksum.write(b'some ')
+            checksum.write(memoryview(b'line'))
+
+        assert checksum.bytes_written == 9
+        assert checksum.sha256.hexdigest() == hashlib.sha256(
+            b'some line').hexdigest()
+
+    def test_open_part(self):
+        file_, checksum = sql2csv.open_part('/tmp/file1.csv.gz')
+        with file_:
+            file_.write('some line')
+
+        with open('/tmp/file1.csv.gz', 'rb') as f:
+            content = f.read()
+
+        assert gzip.decompress(content) == b'some line'
+        assert checksum.bytes_written == len(content)
+
+    def test_write_rows_metrics(self):
+        cursor = FakeCursor((i, 'row é %d' % i) for i in range(25))
+
+        out = StringIO()
+        stream = StringIO()
+        metrics = sql2csv.ExportMetrics(interval=0.000001, stream=stream)
+        count = sql2csv.write_rows(cursor, out, fetch_size=10, metrics=metrics)
+
+        # Same output as without metrics
+        assert count == 25
+        assert out.getvalue() == ''.join('%d,row é %d\r\n' % (i, i) for i in range(25))
+
+        summary = metrics.summary()
+        assert summary['rows'] == 25
+        assert summary['bytes'] == len(out.getvalue().encode('utf-8'))
+        assert summary['time_to_first_row'] is not None
+        assert summary['fetch_time'] > 0 and summary['encode_time'] > 0
+
+        # One progress line per batch
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [line['rows'] for line in lines] == [10, 20, 25, 25]
+        assert lines[0]['event'] == 'progress'
+
+    def test_write_rows_memory_budget_sample(self):
+        cursor = FakeCursor(((i, None if i < 20 else bytes([i])) for i in range(30)),
+                            description=[('id', None), ('data', None)])
+
+        # The first batch of 10 NULL values does not settle the column
+        out = StringIO()
+        sql2csv.write_rows(cursor, out, memory_budget=1024 ** 2)
+        assert out.getvalue().splitlines()[-1] == '29,1d'
+
+    def test_fetch_sizer(self):
+        sizer = sql2csv.FetchSizer(256 * 1024 ** 2)
+        assert sizer.size == sql2csv.ADAPTIVE_FETCH_SIZE
+
+        # Narrow rows grow the batches by 4x at most, up to MAX_FETCH_SIZE
+        sizer.observe(10, 200)
+        assert sizer.size == 40
+        for _ in range(10):
+            sizer.observe(sizer.size, sizer.size * 20)
+        assert sizer.size == sql2csv.MAX_FETCH_SIZE
+
+        # Wide rows shrink them at once
+        sizer.observe(10, 10 * 1024 ** 2)
+        assert sizer.row_bytes > 512 * 1024
+        assert sizer.size < 200
+
+        # A single row larger than the budget is still fetched
+        sizer = sql2csv.FetchSizer(1024)
+        sizer.observe(1, 1024 ** 2)
+        assert sizer.size == 1
+
+    def test_write_rows_memory_budget(self):
+        rows = [(i, 'x' * (10 if i < 500 else 5000)) for i in range(2500)]
+
+        out = StringIO()
+        cursor = FakeCursor(rows)
+        count = sql2csv.write_rows(cursor, out, memory_budget=1024 ** 2)
+
+        # Same output as with a fixed fetch size
+        assert count == 2500
+        assert out.getvalue() == ''.join('%d,%s\r\n' % row for row in rows)
+
+        # Batches grow for narrow rows and shrink once wide rows show up
+        assert cursor.sizes[:4] == [10, 40, 160, 640]
+        assert cursor.sizes[4] < cursor.sizes[3]
+        assert cursor.sizes[-1] < 100
+
+    def test_export_metrics_files(self):
+        metrics = sql2csv.ExportMetrics()
+        with metrics.timer('execute'):
+            pass
+        metrics.add_rows(3)
+        metrics.add_bytes('a,b\r\n')
+
+        metrics.write_summary('/tmp/metrics.json')
+        with open('/tmp/metrics.json') as f:
+            summary = json.load(f)
+        assert summary['rows'] == 3
+        assert summary['bytes'] == 5
+        assert summary['execute_time'] >= 0
+
+        metrics.write_prometheus('/tmp/metrics.prom')
+        with open('/tmp/metrics.prom') as f:
+            content = f.read()
+        assert '# TYPE sql2csv_rows gauge\nsql2csv_rows 3\n' in content
+        assert 'sql2csv_stage_seconds{stage="fetch"} 0.0\n' in content
+
+    def test_write_parts(self):
+        cursor = FakeCursor((i, 'row %d' % i) for i in range(25))
+
+        parts = sql2csv.write_parts(
+            cursor, '/tmp/export.csv', headers=True, fetch_size=7, max_rows=10)
+
+        assert [part['file'] for part in parts] == [
+            'export-00001.csv', 'export-00002.csv', 'export-00003.csv']
+        assert [part['rows'] for part in parts] == [10, 10, 5]
+
+        with open('/tmp/export-00003.csv', 'rb') as f:
+            content = f.read()
+
+        assert content == b'id,name\r\n' + b''.join(
+            b'%d,row %d\r\n' % (i, i) for i in range(20, 25))
+        assert parts[2]['bytes'] == len(content)
+        assert parts[2]['sha256'] == hashlib.sha256(content).hexdigest()
+
+    def test_write_manifest(self):
+        parts = [{'file': 'export-00001.csv', 'rows': 2, 'bytes': 10, 'sha256': 'abc'}]
+
+        name = sql2csv.write_manifest('/tmp/export.csv', parts)
+
+        with open(name) as f:
+            assert json.load(f) == {'rows': 2, 'parts': parts}
+
+    def test_read_write_checkpoint(self):
+        state = {'query': 'SELECT 1', 'column': 'id',
+                 'last_key': date(2018, 12, 1), 'offset': 10, 'rows': 2}
+        sql2csv.write_checkpoint('/tmp/file6.csv', state)
+
+        assert sql2csv.get_checkpoint_name(
+            '/tmp/file6.csv') == '/tmp/file6.csv.checkpoint.json'
+        assert sql2csv.read_checkpoint('/tmp/file6.csv') == dict(
+            state, last_key='2018-12-01')
+        assert sql2csv.read_checkpoint('/tmp/missing.csv') is None
+
+    def test_get_column_index(self):
+        class Cursor:
+            description = [('id', None), ('Name', None)]
+
+        assert sql2csv.get_column_index(Cursor, 'name') == 1
+        self.assertRaises(RuntimeError, sql2csv.get_column_index,
+                          Cursor, 'missing')
+
+    def test_write_resumable(self):
+        class Cursor(FakeCursor):
+            def execute(self, query, params=None):
+                self.query, self.params = query, params
+                self.rows = [(i, 'row %d' % i) for i in range(params[0] + 1, 6)]
+
+        # A previous run was interrupted after a checkpoint on id 2
+        with open('/tmp/file6.csv', 'wb') as f:
+            f.write(b'id,name\r\n1,row 1\r\n2,row 2\r\n3,partial')
+        sql2csv.write_checkpoint('/tmp/file6.csv', {
+            'query': 'SELECT * FROM t', 'column': 'id',
+            'last_key': 2, 'offset': 27, 'rows': 2})
+
+        cursor = Cursor([])
+        count = sql2csv.write_resumable(
+            cursor, 'SELECT * FROM t', '/tmp/file6.csv', 'id', headers=True)
+
+        assert cursor.query == 'SELECT * FROM (SELECT * FROM t) AS sql2csv_src WHERE id > %s ORDER BY id'
+        assert cursor.params == (2,)
+        assert count == 3
+        with open('/tmp/file6.csv', 'rb') as f:
+            assert f.read() == b'id,name\r\n' + b''.join(
+                b'%d,row %d\r\n' % (i, i) for i in range(1, 6))
+
+        # The checkpoint is removed once the export is complete
+        assert sql2csv.read_checkpoint('/tmp/file6.csv') is None
+
+    def test_write_resumable_other_query(self):
+        sql2csv.write_checkpoint('/tmp/file6.csv', {
+            'query': 'SELECT * FROM t', 'column': 'id',
+            'last_key': 2, 'offset': 27, 'rows': 2})
+
+        self.assertRaises(RuntimeError, sql2csv.write_resumable,
+                          None, 'SELECT * FROM other', '/tmp/file6.csv', 'id')
+
+    def test_parse_size(self):
+        assert sql2csv.parse_size('100') == 100
+        assert sql2csv.parse_size('100B') == 100
+        assert sql2csv.parse_size('2KB') == 2048
+        assert sql2csv.parse_size('1.5mb') == 1572864
+        assert sql2csv.parse_size('1GB') == 1024 ** 3
+
+    def test_parse_positive_size(self):
+        import argparse
+
+        assert sql2csv.parse_positive_size('1KB') == 1024
+        self.assertRaises(argparse.ArgumentTypeError, sql2csv.parse_positive_size, '0')
+        self.assertRaises(argparse.ArgumentTypeError, sql2csv.parse_positive_size, '-1MB')
+
+    def test_load_jobs(self):
+        with open('/tmp/jobs.yml', 'w') as file_:
+            file_.write("""concurrency: 2
+defaults:
+  engine: postgresql
+  user: some_user
+jobs:
+  - query: SELECT 1
+    destination_file: /tmp/jobs_1.csv
+  - query: SELECT 2
+    destination_file: /tmp/jobs_2.parquet
+    format: parquet
+    user: other_user
+""")
+
+        jobs, concurrency = sql2csv.load_jobs(
+            '/tmp/jobs.yml', defaults={'engine': 'mysql', 'database': 'some_db'})
+
+        assert concurrency == 2
+        assert jobs[0] == {'engine': 'postgresql', 'host': '127.0.0.1', 'port': 5432,
+                           'user': 'some_user', 'password': '', 'database': 'some_db',
+                           'query': 'SELECT 1', 'destination_file': '/tmp/jobs_1.csv',
+                           'out_type': 'file'}
+        assert jobs[1]['user'] == 'other_user'
+        assert jobs[1]['format_'] == 'parquet'
+
+    def test_load_jobs_json(self):
+        with open('/tmp/jobs.json', 'w') as file_:
+            json.dump([{'query': 'SELECT 1', 'destination_file': '/tmp/jobs_1.csv'}], file_)
+
+        jobs, concurrency = sql2csv.load_jobs(
+            '/tmp/jobs.json', defaults={'user': 'some_user', 'database': 'some_db'})
+
+        assert concurrency is None
+        assert jobs[0]['port'] == 3306
+
+        # Missing query
+        self.assertRaises(RuntimeError, sql2csv.load_jobs, '/tmp/jobs.json')
+
+    def test_run_jobs(self):
+        opened = []
+
+        def get_connection(**kwargs):
+            opened.append(FakeConnection())
+            return opened[-1]
+
+        exported = []
+
+        def query_to_csv(pool, **job):
+            with pool.connection(**{key: job[key] for key in sql2csv.CONNECTION_KEYS}):
+                if job['query'] == 'fail':
+                    raise ValueError('Some error')
+                exported.append(job['destination_file'])
+
+        job = {'engine': 'mysql', 'host': '127.0.0.1', 'port': 3306, 'user': 'some_user',
+               'password': '', 'database': 'some_db', 'query': 'SELECT 1'}
+        jobs = [dict(job, destination_file='/tmp/jobs_%d.csv' % i) for i in range(5)]
+
+        with patch.object(sql2csv, 'get_connection', get_connection), \
+                patch.object(sql2csv, 'query_to_csv', query_to_csv):
+            # A single thread reuses its connection
+            sql2csv.run_jobs(jobs, concurrency=1)
+
+            assert len(opened) == 1
+            assert sorted(exported) == [job['destination_file'] for job in jobs]
+            assert opened[0].closed
+
+            # Failures are reported once every job ran
+            self.assertRaises(RuntimeError, sql2csv.run_jobs,
+                              jobs + [dict(job, query='fail', destination_file='/tmp/fail.csv')])
+            assert len(exported) == 10
+
+    def test_connection_pool(self):
+        args = {'engine': 'mysql', 'host': '127.0.0.1', 'port': 3306,
+                'user': 'some_user', 'password': '', 'database': 'some_db'}
+
+        with patch.object(sql2csv, 'get_connection', lambda **kwargs: FakeConnection()):
+            pool = sql2csv.ConnectionPool(max_size=2)
+
+            # Released connections are rolled back and reused
+            connection = pool.acquire(**args)
+            pool.release(connection)
+            assert connection.rollbacks == 1
+            assert pool.acquire(**args) is connection
+            assert connection.pings == 1
+
+            # Other keys get their own connections
+            other = pool.acquire(**dict(args, database='other_db'))
+            assert other is not connection
+
+            # Broken connections are replaced
+            pool.release(other)
+            other.alive = False
+            assert pool.acquire(**dict(args, database='other_db')) is not other
+            assert other.closed
+
+            # Connections are discarded on errors
+            try:
+                with pool.connection(**args) as failed:
+                    raise ValueError('Some error')
+            except ValueError:
+                pass
+            assert failed.closed
+
+            pool.release(connection)
+            pool.close()
+            assert connection.closed
+            self.assertRaises(RuntimeError, pool.acquire, **args)
+
+    def test_connection_pool_max_size(self):
+        args = {'engine': 'postgresql', 'host': '127.0.0.1', 'port': 5432,
+                'user': 'some_user', 'password': '', 'database': 'some_db'}
+
+        with patch.object(sql2csv, 'get_connection', lambda **kwargs: FakeConnection()):
+            pool = sql2csv.ConnectionPool(max_size=1, idle_timeout=0)
+            connection = pool.acquire(**args)
+
+            # Waits until the connection in use is released
+            acquired = []
+            thread = threading.Thread(
+                target=lambda: acquired.append(pool.acquire(**args)))
+            thread.start()
+            thread.join(0.1)
+            assert not acquired
+
+            pool.release(connection)
+            thread.join()
+
+            # Expired connections are closed instead of reused
+            assert acquired[0] is not connection
+            assert connection.closed
+
+    def test_borrow_connection(self):
+        connection = FakeConnection()
+        with patch.object(sql2csv, 'get_connection', lambda **kwargs: connection):
+            # New connections are closed on exit
+            with sql2csv.borrow_connection(engine='mysql') as borrowed:
+                assert borrowed is connection
+            assert connection.closed
+
+        # Connections passed in are left open
+        connection = FakeConnection()
+        with sql2csv.borrow_connection(connection=connection) as borrowed:
+            assert borrowed is connection
+        assert not connection.closed
+
+    def test_background_writer(self):
+        out = BytesIO()
+        writer = sql2csv.BackgroundWriter(out)
+        for i in range(100):
+            writer.write(b'%d,' % i)
+
+        # Closing waits for pending writes
+        out.close = lambda: None
+        writer.close()
+        assert out.getvalue() == b''.join(b'%d,' % i for i in range(100))
+
+    def test_double_buffered_writer(self):
+        class Raw(BytesIO):
+            chunks = []
+
+            def write(self, b):
+                self.chunks.append(len(b))
+                return super().write(b)
+
+        raw = Raw()
+        raw.close = lambda: None
+        writer = sql2csv.DoubleBufferedWriter(raw, buffer_size=16)
+        for i in range(100):
+            writer.write(b'%d,' % i)
+        writer.write(b'x' * 40)
+
+        # Chunks are the size of the buffer until the last one
+        writer.close()
+        assert raw.getvalue() == b''.join(b'%d,' % i for i in range(100)) + b'x' * 40
+        assert raw.chunks[:-1] == [16] * (len(raw.chunks) - 1)
+        assert 0 < raw.chunks[-1] <= 16
+
+    def test_double_buffered_writer_error(self):
+        class Raw(BytesIO):
+            def write(self, b):
+                raise OSError('No space left on device')
+
+        writer = sql2csv.DoubleBufferedWriter(Raw(), buffer_size=4)
+        writer.write(b'some line')
+
+        # The error of the background thread is raised to the caller
+        self.assertRaises(OSError, writer.close)
+        assert writer.closed
+
+    def test_double_buffered_writer_invalid_size(self):
+        for size in (0, -1):
+            raw = BytesIO()
+            self.assertRaises(RuntimeError, sql2csv.DoubleBufferedWriter, raw, buffer_size=size)
+            assert raw.closed
+
+    def test_open_file_fsync(self):
+        with patch.object(sql2csv.os, 'fsync') as fsync, patch.object(sql2csv.os, 'posix_fadvise', create=True) as fadvise:
+            with sql2csv.open_file('/tmp/file1', write_buffer_size=4, fsync='chunk', drop_cache=True) as file_:
+                file_.write('some line\r\n')
+
+        with open('/tmp/file1', 'rb') as f:
+            assert f.read() == b'some line\r\n'
+
+        # One sync per chunk (4, 4 and the last 3 bytes) and once closed
+        assert fsync.call_count == 4
+        if hasattr(os, 'POSIX_FADV_DONTNEED'):
+            assert fadvise.call_args[0][1:] == (0, 0, os.POSIX_FADV_DONTNEED)
+
+    def test_open_stdout(self):
+        saved_stdout = sys.stdout
+        try:
+            out = TextIOWrapper(BytesIO(), encoding='utf-8')
+            sys.stdout = out
+
+            with sql2csv.open_stdout() as file_:
+                file_.write('some line\r\n')
+                file_.write('some other line')
+
+            # The wrapper is detached, `sys.stdout` stays usable
+            assert not out.closed
+            assert out.buffer.getvalue() == b'some line\r\nsome other line'
+        finally:
+            sys.stdout = saved_stdout
+
+    def test_open_stdout_text_stream(self):
+        with patch("sys.stdout", StringIO()) as out:
+            with sql2csv.open_stdout() as file_:
+                file_.write('some line')
+
+            assert out.getvalue() == 'some line'
 
     def test_get_writer(self):
-        file_ = sql2csv.open_tempfile()
+        file_ = sql2csv.open_file('/tmp/file1')
         writer = sql2csv.get_writer(file_)
 
         self.assertIsInstance(writer, object)
 
-    def test_file_to_stdout(self):
-        with tempfile.NamedTemporaryFile(mode='w+', newline='') as file_:
-            # Write some dummy content
-            file_.write('some line\n')
-            file_.write('some other line')
-            file_.flush()
-
-            saved_stdout = sys.stdout
-            try:
-                out = StringIO()
-                sys.stdout = out
-
-                # Render file content to stdout
-                sql2csv.file_ = file_
-                sql2csv.file_to_stdout()
+    def test_get_writer_lineterminator(self):
+        out = StringIO()
+        writer = sql2csv.get_writer(out, lineterminator='\n')
+        writer.writerow(['a', 'b,c'])
 
-                output = out.getvalue().strip()
-                assert output == 'some line\nsome other line'
-            finally:
-                sys.stdout = saved_stdout
+        assert out.getvalue() == 'a,"b,c"\n'
 
     def test_stdin_to_csv(self):
         with patch("sys.stdin", StringIO(""" id | some_int |  some_str   |      some_date
@@ -281,6 +1283,62 @@ class Test(unittest.TestCase):
             finally:
                 sys.stdout = saved_stdout
 
+    def test_stdin_to_csv_mysql_table(self):
+        with patch("sys.stdin", StringIO("""+----+-------------+
+| id | some_str    |
++----+-------------+
+|  1 | hello world |
+|  2 | hello       |
++----+-------------+
+""")):
+            saved_stdout = sys.stdout
+            try:
+                out = StringIO()
+                sys.stdout = out
+
+                # Parse input and render CSV to stdout
+                sql2csv.stdin_to_csv()
+
+                assert out.getvalue() == """id,some_str
+1,hello world
+2,hello
+"""
+            finally:
+                sys.stdout = saved_stdout
+
+    def test_stdin_to_csv_negative_numbers(self):
+        with patch("sys.stdin", StringIO(""" some_int
+----------
+       -12
+        15
+(2 rows)
+""")):
+            saved_stdout = sys.stdout
+            try:
+                out = StringIO()
+                sys.stdout = out
+
+                # Rows starting with `-` are kept
+                sql2csv.stdin_to_csv()
+
+                assert out.getvalue() == "some_int\n-12\n15\n"
+            finally:
+                sys.stdout = saved_stdout
+
+    def test_stdin_to_csv_input_format(self):
+        with patch("sys.stdin", StringIO("id|name\n1|a\n")):
+            saved_stdout = sys.stdout
+            try:
+                out = StringIO()
+                sys.stdout = out
+
+                # Forced format is not sniffed
+                sql2csv.stdin_to_csv(input_format='mysql-batch')
+
+                assert out.getvalue() == "id|name\n1|a\n"
+            finally:
+                sys.stdout = saved_stdout
+
     def test_query_to_csv_mysql(self):
         db_config = self.db_configs['mysql']
 
@@ -308,6 +1366,284 @@ class Test(unittest.TestCase):
 3,18,world,2018-12-08 12:17:12
 """
 
+    def test_query_to_csv_sqlite(self):
+        db_config = self.db_configs['sqlite']
+
+        dest_file = '/tmp/file_sqlite'
+
+        sql2csv.query_to_csv(
+            engine='sqlite',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_sqlite_table',
+            headers=True,
+            out_type='file',
+            destination_file=dest_file
+        )
+
+        # Read file
+        with open(dest_file, 'r') as content_file:
+            content = content_file.read()
+
+        assert content == """id,some_int,some_str,some_date
+1,12,hello world,2018-12-01 12:23:12
+2,15,hello,2018-12-05 12:18:12
+3,18,world,2018-12-08 12:17:12
+"""
+
+    def test_query_to_csv_sqlite_binary(self):
+        db_config = self.db_configs['sqlite']
+
+        dest_file = '/tmp/file_sqlite_binary'
+
+        sql2csv.query_to_csv(
+            engine='sqlite',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query="SELECT id, x'01ff' FROM some_sqlite_table",
+            out_type='file',
+            destination_file=dest_file,
+            binary_format='base64'
+        )
+
+        # Read file
+        with open(dest_file, 'r') as content_file:
+            content = content_file.read()
+
+        # Blobs are encoded, not written as "b'...'"
+        assert content == "1,Af8=\n2,Af8=\n3,Af8=\n"
+
+    def test_query_to_csv_watermark(self):
+        database = '/tmp/sql2csv_watermark.sqlite'
+        dest_file = '/tmp/file_sqlite_watermark'
+        state_file = dest_file + '.watermark.json'
+        shutil.copy(self.db_configs['sqlite']['db'], database)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+        def export():
+            sql2csv.query_to_csv(
+                engine='sqlite',
+                host=None,
+                user=None,
+                port=None,
+                password=None,
+                database=database,
+                query='SELECT id, some_str FROM some_sqlite_table',
+                out_type='file',
+                destination_file=dest_file,
+                watermark_column='id'
+            )
+
+            with open(dest_file, 'r') as content_file:
+                return content_file.read()
+
+        # The first run exports every row and records the highest id
+        assert export() == "1,hello world\n2,hello\n3,world\n"
+        with open(state_file) as f:
+            state = json.load(f)
+        entry = list(state.values())[0]
+        assert entry['watermark'] == 3
+        assert entry['rows'] == 3
+
+        # Only new rows are exported by the next runs
+        connection = sqlite3.connect(database)
+        connection.execute(
+            "INSERT INTO some_sqlite_table (id, some_int, some_str) VALUES (4, 21, 'new')")
+        connection.commit()
+        connection.close()
+        assert export() == "4,new\n"
+
+        # An empty delta keeps the watermark
+        assert export() == ""
+        with open(state_file) as f:
+            assert list(json.load(f).values())[0]['watermark'] == 4
+
+    def test_get_watermark_key(self):
+        key = sql2csv.get_watermark_key(
+            'mysql', 'localhost', 'db', 'SELECT * FROM t;', 'id')
+
+        assert key == sql2csv.get_watermark_key(
+            'mysql', 'localhost', 'db', 'SELECT * FROM t', 'id')
+        assert key != sql2csv.get_watermark_key(
+            'mysql', 'localhost', 'db', 'SELECT * FROM t', 'updated_at')
+
+    def test_query_to_csv_watermark_invalid(self):
+        db_config = self.db_configs['sqlite']
+
+        for kwargs in ({'out_type': 'file', 'destination_file': '/tmp/file_watermark', 'resume': True, 'checkpoint_column': 'id'},
+                       {'out_type': 'file', 'destination_file': '/tmp/file_watermark', 'format_': 'parquet'},
+                       {'out_type': 'stdout'}):
+            with self.assertRaises(RuntimeError):
+                sql2csv.query_to_csv(
+                    engine='sqlite',
+                    host=db_config['host'],
+                    user=db_config['user'],
+                    port=db_config['port'],
+                    password=db_config['password'],
+                    database=db_config['db'],
+                    query='SELECT * FROM some_sqlite_table',
+                    watermark_column='id',
+                    **kwargs
+                )
+
+    def test_query_to_csv_sqlite_binary_null_first_batch(self):
+        db_config = self.db_configs['sqlite']
+
+        dest_file = '/tmp/file_sqlite_binary_null'
+
+        sql2csv.query_to_csv(
+            engine='sqlite',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query="SELECT id, CASE WHEN id > 2 THEN x'05' END FROM some_sqlite_table",
+            out_type='file',
+            destination_file=dest_file,
+            fetch_size=2
+        )
+
+        with open(dest_file, 'r') as content_file:
+            content = content_file.read()
+
+        # Blobs after a first batch of NULL values are still encoded
+        assert content == "1,\n2,\n3,05\n"
+
+    def test_query_to_csv_sqlite_parallel(self):
+        db_config = self.db_configs['sqlite']
+
+        dest_file = '/tmp/file_sqlite_parallel'
+
+        sql2csv.query_to_csv(
+            engine='sqlite',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query="SELECT id, some_str FROM some_sqlite_table WHERE some_str LIKE '%o%'",
+            out_type='file',
+            destination_file=dest_file,
+            parallel=2,
+            split_column='id'
+        )
+
+        # Read file
+        with open(dest_file, 'r') as content_file:
+            content = content_file.read()
+
+        assert content == "1,hello world\n2,hello\n3,world\n"
+
+    def test_query_to_csv_sqlite_parallel_error(self):
+        db_config = self.db_configs['sqlite']
+
+        connections = []
+        get_connection = sql2csv.get_connection
+
+        def record_connection(**kwargs):
+            connections.append(MagicMock(wraps=get_connection(**kwargs)))
+            return connections[-1]
+
+        # Connections are closed when a chunk fails
+        with patch.object(sql2csv, 'get_connection', side_effect=record_connection), \
+                patch.object(sql2csv, 'write_rows', side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, sql2csv.query_to_csv,
+                              engine='sqlite',
+                              host=db_config['host'],
+                              user=db_config['user'],
+                              port=db_config['port'],
+                              password=db_config['password'],
+                              database=db_config['db'],
+                              query='SELECT id, some_str FROM some_sqlite_table',
+                              out_type='file',
+                              destination_file='/tmp/file_sqlite_parallel_error',
+                              parallel=2,
+                              split_column='id')
+
+        assert len(connections) == 3
+        assert all(connection.close.called for connection in connections)
+
+    def test_query_to_csv_cache(self):
+        db_config = self.db_configs['sqlite']
+        shutil.rmtree('/tmp/sql2csv_cache', ignore_errors=True)
+
+        args = dict(
+            engine='sqlite',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT id, some_str FROM some_sqlite_table',
+            out_type='file',
+            destination_file='/tmp/file_sqlite_cache',
+            cache_dir='/tmp/sql2csv_cache'
+        )
+        expected = "1,hello world\n2,hello\n3,world\n"
+
+        sql2csv.query_to_csv(**args)
+        assert len(os.listdir('/tmp/sql2csv_cache')) == 1
+        os.remove('/tmp/file_sqlite_cache')
+
+        # A hit does not connect to the database
+        with patch.object(sql2csv, 'get_connection', side_effect=AssertionError):
+            sql2csv.query_to_csv(**args)
+            with open('/tmp/file_sqlite_cache') as content_file:
+                assert content_file.read() == expected
+
+            # Expired
+            self.assertRaises(AssertionError, sql2csv.query_to_csv,
+                              **dict(args, cache_ttl=0))
+
+        # The result of the freshness query is part of the key
+        args['freshness_query'] = 'SELECT max(id) FROM some_sqlite_table'
+        sql2csv.query_to_csv(**args)
+        assert len(os.listdir('/tmp/sql2csv_cache')) == 2
+
+        # Only the freshness query runs on a hit
+        with patch.object(sql2csv, 'write_rows', side_effect=AssertionError):
+            sql2csv.query_to_csv(**args)
+
+    def test_query_to_csv_cache_stdout(self):
+        self.assertRaises(RuntimeError, sql2csv.query_to_csv, engine='sqlite', host=None,
+                          user=None, port=None, password=None, database='/tmp/sql2csv.sqlite',
+                          query='SELECT 1', cache_dir='/tmp/sql2csv_cache')
+
+    def test_get_cache_key(self):
+        args = {'engine': 'mysql', 'host': 'localhost', 'query': 'SELECT 1',
+                'password': 'secret', 'destination_file': '/tmp/file.csv'}
+        key = sql2csv.get_cache_key(args)
+
+        assert key == sql2csv.get_cache_key(dict(args, password='other'))
+        assert key != sql2csv.get_cache_key(dict(args, query='SELECT 2'))
+        assert key != sql2csv.get_cache_key(dict(args, destination_file='/tmp/file.csv.gz'))
+        assert key != sql2csv.get_cache_key(args, freshness=[1])
+
+    def test_write_cache_eviction(self):
+        shutil.rmtree('/tmp/sql2csv_cache', ignore_errors=True)
+        os.makedirs('/tmp/sql2csv_cache')
+
+        for atime, key in enumerate(['a', 'b']):
+            name = '/tmp/sql2csv_cache/%s.cache' % (key)
+            with open(name, 'w') as f:
+                f.write('x' * 10)
+            os.utime(name, (atime, atime))
+        with open('/tmp/file_cache_source', 'w') as f:
+            f.write('y' * 10)
+
+        sql2csv.write_cache('/tmp/sql2csv_cache', 'c', '/tmp/file_cache_source', max_size=25)
+
+        # The least recently used entry is evicted
+        assert sorted(os.listdir('/tmp/sql2csv_cache')) == ['b.cache', 'c.cache']
+
     def test_query_to_csv_mysql_headers(self):
         db_config = self.db_configs['mysql']
 
@@ -390,3 +1726,254 @@ class Test(unittest.TestCase):
 3,18,world,2018-12-08 12:17:12"""
         finally:
             sys.stdout = saved_stdout
+
+    def test_query_to_csv_postgresql_native_copy(self):
+        db_config = self.db_configs['pg']
+
+        dest_file = '/tmp/file2'
+
+        sql2csv.query_to_csv(
+            engine='postgresql',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_pg_table;',
+            headers=True,
+            out_type='file',
+            destination_file=dest_file,
+            native_copy=True
+        )
+
+        # Read file
+        with open(dest_file, 'r') as content_file:
+            content = content_file.read()
+
+        assert content == """id,some_int,some_str,some_date
+1,12,hello world,2018-12-01 12:23:12
+2,15,hello,2018-12-05 12:18:12
+3,18,world,2018-12-08 12:17:12
+"""
+
+    def test_query_to_csv_mysql_native_copy(self):
+        db_config = self.db_configs['mysql']
+
+        dest_file = '/tmp/file2'
+
+        sql2csv.query_to_csv(
+            engine='mysql',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT id, some_int, CONCAT(some_str, \', "quoted"\') AS some_str, some_date, NULL AS empty FROM some_mysql_table;',
+            headers=True,
+            out_type='file',
+            destination_file=dest_file,
+            native_copy=True
+        )
+
+        # Read file
+        with open(dest_file, 'r') as content_file:
+            content = content_file.read()
+
+        assert content.splitlines() == [
+            'id,some_int,some_str,some_date,empty',
+            '1,12,"hello world, ""quoted""",2018-12-01 12:23:12,',
+            '2,15,"hello, ""quoted""",2018-12-05 12:18:12,',
+            '3,18,"world, ""quoted""",2018-12-08 12:17:12,'
+        ]
+
+    def test_query_to_csv_native_copy_invalid_engine(self):
+        db_config = self.db_configs['sqlite']
+
+        self.assertRaises(
+            RuntimeError,
+            sql2csv.query_to_csv,
+            engine='sqlite',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_mysql_table',
+            native_copy=True
+        )
+
+    def test_query_to_csv_mysql_parallel(self):
+        db_config = self.db_configs['mysql']
+
+        dest_file = '/tmp/file3.csv'
+
+        sql2csv.query_to_csv(
+            engine='mysql',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_mysql_table',
+            headers=True,
+            out_type='file',
+            destination_file=dest_file,
+            parallel=2,
+            split_column='id'
+        )
+
+        # Read file
+        with open(dest_file, 'r') as content_file:
+            content = content_file.read()
+
+        assert content == """id,some_int,some_str,some_date
+1,12,hello world,2018-12-01 12:23:12
+2,15,hello,2018-12-05 12:18:12
+3,18,world,2018-12-08 12:17:12
+"""
+
+    def test_query_to_csv_postgresql_parallel_part_files(self):
+        db_config = self.db_configs['pg']
+
+        dest_file = '/tmp/file3.csv'
+
+        sql2csv.query_to_csv(
+            engine='postgresql',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_pg_table',
+            headers=True,
+            out_type='file',
+            destination_file=dest_file,
+            parallel=2,
+            split_column='id',
+            part_files=True
+        )
+
+        # Read files
+        with open('/tmp/file3-00001.csv', 'r') as content_file:
+            content = content_file.read()
+
+        assert content == """id,some_int,some_str,some_date
+1,12,hello world,2018-12-01 12:23:12
+"""
+
+        with open('/tmp/file3-00002.csv', 'r') as content_file:
+            content = content_file.read()
+
+        assert content == """id,some_int,some_str,some_date
+2,15,hello,2018-12-05 12:18:12
+3,18,world,2018-12-08 12:17:12
+"""
+
+    def test_query_to_csv_parallel_without_split_column(self):
+        db_config = self.db_configs['mysql']
+
+        self.assertRaises(
+            RuntimeError,
+            sql2csv.query_to_csv,
+            engine='mysql',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_mysql_table',
+            parallel=2
+        )
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_query_to_csv_mysql_parquet(self):
+        db_config = self.db_configs['mysql']
+
+        dest_file = '/tmp/file4.parquet'
+
+        sql2csv.query_to_csv(
+            engine='mysql',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_mysql_table',
+            out_type='file',
+            destination_file=dest_file,
+            format_='parquet',
+            row_group_size=2
+        )
+
+        table = pyarrow.parquet.read_table(dest_file)
+
+        assert table.column_names == ['id', 'some_int', 'some_str', 'some_date']
+        assert table.column('some_str').to_pylist() == [
+            'hello world', 'hello', 'world']
+        assert pyarrow.parquet.ParquetFile(
+            dest_file).metadata.num_row_groups == 2
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_query_to_csv_sqlite_parquet_binary_null_first_batch(self):
+        db_config = self.db_configs['sqlite']
+
+        # Blobs after a first batch of NULL values are not decoded as text
+        self.assertRaises(
+            RuntimeError,
+            sql2csv.query_to_csv,
+            engine='sqlite',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query="SELECT id, CASE WHEN id > 2 THEN x'ff' END AS data FROM some_sqlite_table",
+            out_type='file',
+            destination_file='/tmp/file_sqlite_binary_null.parquet',
+            format_='parquet',
+            row_group_size=2
+        )
+
+    def test_query_to_csv_columnar_stdout(self):
+        db_config = self.db_configs['mysql']
+
+        self.assertRaises(
+            RuntimeError,
+            sql2csv.query_to_csv,
+            engine='mysql',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_mysql_table',
+            format_='parquet'
+        )
+
+    def test_query_to_csv_mysql_max_rows_per_file(self):
+        db_config = self.db_configs['mysql']
+
+        sql2csv.query_to_csv(
+            engine='mysql',
+            host=db_config['host'],
+            user=db_config['user'],
+            port=db_config['port'],
+            password=db_config['password'],
+            database=db_config['db'],
+            query='SELECT * FROM some_mysql_table',
+            headers=True,
+            out_type='file',
+            destination_file='/tmp/file5.csv',
+            max_rows_per_file=2
+        )
+
+        # Read files
+        with open('/tmp/file5-00002.csv', 'r') as content_file:
+            content = content_file.read()
+
+        assert content == """id,some_int,some_str,some_date
+3,18,world,2018-12-08 12:17:12
+"""
+
+        with open('/tmp/file5.manifest.json', 'r') as manifest:
+            assert [part['rows'] for part in json.load(manifest)['parts']] == [2, 1]